@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+SESSION_METADATA_KEY = "x-session-token"
+
+
+class AuthBusy(Exception):
+    pass
+
+
+def ignore_sigint():
+    # Ctrl+C reaches the pool processes too; the server shuts them down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+
+
+def check_password(password, password_hash):
+    return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+
+class PasswordHasher:
+    # Runs bcrypt in a small process pool so password hashing never competes with chat
+    # delivery for the GIL. At most max_pending calls may be queued or running; beyond
+    # that callers get AuthBusy right away instead of piling up on RPC threads.
+    def __init__(self, workers=2, max_pending=64, timeout=30):
+        # spawn, not fork: forking a process that already runs gRPC threads is unsafe
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=ignore_sigint)
+        self.admission = threading.BoundedSemaphore(max_pending)
+        self.timeout = timeout
+
+    def run(self, func, *args):
+        if not self.admission.acquire(blocking=False):
+            raise AuthBusy("Server is busy, please try again")
+        try:
+            return self.executor.submit(func, *args).result(timeout=self.timeout)
+        finally:
+            self.admission.release()
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def check(self, password, password_hash):
+        return self.run(check_password, password, password_hash)
+
+    def close(self):
+        # Waits for at most the hash in progress; without wait, Python 3.11 can leave a worker
+        # blocked on its call queue and the server process hangs on exit
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class SessionManager:
+    # Stateless session tokens: base64(username).expiry.hmac. Verifying one is a single
+    # HMAC, with no database or bcrypt work. Servers that must accept each other's tokens
+    # share the secret through CHAT_SESSION_SECRET.
+    def __init__(self, secret=None, ttl=24 * 3600):
+        secret = secret or os.environ.get("CHAT_SESSION_SECRET")
+        self.secret = secret.encode() if secret else secrets.token_bytes(32)
+        self.ttl = ttl
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, username):
+        user_part = base64.urlsafe_b64encode(username.encode()).decode()
+        payload = f"{user_part}.{int(time.time()) + self.ttl}"
+        return f"{payload}.{self.sign(payload)}"
+
+    def verify(self, token):
+        # Returns the username the token was issued to, or None
+        try:
+            user_part, expiry, signature = token.split(".")
+            payload = f"{user_part}.{expiry}"
+            if not hmac.compare_digest(signature, self.sign(payload)):
+                return None
+            if int(expiry) < time.time():
+                return None
+            return base64.urlsafe_b64decode(user_part.encode()).decode()
+        except (ValueError, UnicodeDecodeError):
+            return None
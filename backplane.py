@@ -0,0 +1,428 @@
+import hashlib
+import hmac
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from logs import get_logger
+
+log = get_logger("backplane")
+
+# Frame kinds exchanged between nodes
+HELLO = 1       # first frame on a link: proof of the shared secret + the sending node's id
+PRESENCE = 2    # all usernames with a Chat stream on the sending node, sent on (re)connect
+ONLINE = 3      # a user just opened a Chat stream on the sending node
+OFFLINE = 4     # usernames whose Chat stream on the sending node ended
+DELIVER = 5     # usernames on the receiving node + one serialized ChatMessage
+INVALIDATE = 6  # group id whose cached membership changed
+GROUP_DELIVER = 7  # group id + one serialized ChatMessage, for the receiving node's online members
+SUBMIT = 8      # a group message sent by a client of the sending node, for the group's owner to number
+
+FRAME_HEADER = struct.Struct(">IB")
+COUNT = struct.Struct(">H")
+GROUP_ID = struct.Struct(">q")
+
+CHALLENGE_SIZE = 32  # random bytes the accepting node sends first; HELLO answers with their HMAC
+MAC_SIZE = hashlib.sha256().digest_size
+MAX_HELLO_SIZE = 1024
+HANDSHAKE_TIMEOUT = 5
+
+
+def backplane_secret():
+    # Nodes prove to each other that they share CHAT_SESSION_SECRET, which they need
+    # anyway to accept each other's session tokens
+    secret = os.environ.get("CHAT_SESSION_SECRET")
+    if not secret:
+        raise ValueError("Set CHAT_SESSION_SECRET to the same value on every node to use the backplane")
+    return secret.encode()
+
+
+def hello_mac(secret, challenge, node_id):
+    return hmac.new(secret, challenge + node_id.encode(), hashlib.sha256).digest()
+
+
+class LocalBackplane:
+    # Single-process deployment: every stream is local, so there is nothing to route
+    def start(self, node):
+        self.node = node
+
+    def user_online(self, username):
+        pass
+
+    def user_offline(self, username):
+        pass
+
+    def forward(self, usernames, payload):
+        # Returns the usernames that were handed to another node
+        return []
+
+    def forward_group(self, group_id, payload):
+        pass
+
+    def group_owner(self, group_id):
+        # None: this node numbers the group's messages
+        return None
+
+    def invalidate_group(self, group_id):
+        pass
+
+    def close(self):
+        pass
+
+
+def encode_names(names):
+    parts = [COUNT.pack(len(names))]
+    for name in names:
+        data = name.encode()
+        parts.append(COUNT.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_names(body):
+    (count,), offset = COUNT.unpack_from(body), COUNT.size
+    names = []
+    for _ in range(count):
+        (length,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        names.append(body[offset:offset + length].decode())
+        offset += length
+    return names, offset
+
+
+def listen(address):
+    # address is host:port, or unix:/path for workers on the same machine
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a previous run of this node
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen()
+        return sock
+    host, port = address.rsplit(":", 1)
+    return socket.create_server((host, int(port)))
+
+
+def dial(address):
+    if address.startswith("unix:"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address[len("unix:"):])
+        return sock
+    host, port = address.rsplit(":", 1)
+    sock = socket.create_connection((host, int(port)), timeout=5)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def peer_closed(sock):
+    # The accepting side never writes on a link after its challenge, so anything to read
+    # means it went away. Checked before writing: a frame written to a closed peer is
+    # accepted by the kernel and lost without an error.
+    try:
+        return not sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return False
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Peer closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+class PeerLink:
+    # Outgoing connection to one peer. Frames are queued and written by a dedicated
+    # thread, so fan-out never blocks on a slow or unreachable node; when the queue is
+    # full, frames for that node are dropped and counted.
+    def __init__(self, address, node_id, secret, max_pending=10000):
+        self.address = address
+        self.node_id = node_id
+        self.secret = secret
+        self.max_pending = max_pending
+        self.frames = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.held = deque()  # frames kept while the link is down, sent first once it is up
+        self.connected = False
+        self.closed = False
+        self.dropped = 0
+        self.on_connect = None  # returns the frames to send first after every (re)connect
+        self.thread = threading.Thread(target=self.run, name=f"backplane-{address}", daemon=True)
+
+    def send(self, kind, body):
+        if not self.connected:
+            return False
+        try:
+            self.frames.put_nowait(FRAME_HEADER.pack(len(body), kind) + body)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def hold(self, kind, body):
+        # Like send, but while the link is down the frame is kept (up to max_pending of them)
+        # and written once the link is back, instead of being refused
+        with self.lock:
+            if not self.connected:
+                if len(self.held) >= self.max_pending:
+                    self.dropped += 1
+                    return False
+                self.held.append(FRAME_HEADER.pack(len(body), kind) + body)
+                return True
+        return self.send(kind, body)
+
+    def run(self):
+        while not self.closed:
+            try:
+                sock = dial(self.address)
+            except OSError:
+                time.sleep(1)
+                continue
+            batch = []  # frames taken off the queue but not yet written
+            try:
+                sock.settimeout(HANDSHAKE_TIMEOUT)
+                challenge = recv_exact(sock, CHALLENGE_SIZE)
+                sock.settimeout(None)
+                hello = hello_mac(self.secret, challenge, self.node_id) + self.node_id.encode()
+                sock.sendall(FRAME_HEADER.pack(len(hello), HELLO) + hello)
+                # Accept frames before taking the snapshot, so no presence change falls in between
+                with self.lock:
+                    self.connected = True
+                    held, self.held = self.held, deque()
+                for kind, body in self.on_connect():
+                    sock.sendall(FRAME_HEADER.pack(len(body), kind) + body)
+                if held:
+                    batch = list(held)
+                    sock.sendall(b"".join(batch))
+                    batch = []
+                log.info("backplane connected", peer=self.address)
+                while not self.closed:
+                    frame = self.frames.get()
+                    if frame is None:
+                        break
+                    # Write whatever else is already queued in the same syscall
+                    batch = [frame]
+                    while len(batch) < 256:
+                        try:
+                            frame = self.frames.get_nowait()
+                        except queue.Empty:
+                            break
+                        if frame is None:
+                            break
+                        batch.append(frame)
+                    if peer_closed(sock):
+                        raise ConnectionError("Peer closed the connection")
+                    sock.sendall(b"".join(batch))
+                    batch = []
+            except OSError as e:
+                log.warning("backplane link lost", peer=self.address, error=e)
+            finally:
+                with self.lock:
+                    self.connected = False
+                sock.close()
+            # Frames queued while the link was down refer to stale presence; submitted
+            # messages go ahead of the ones held since, for the next connection. The owner
+            # drops any of them that did arrive by their client message id.
+            unsent = [frame for frame in batch if frame[FRAME_HEADER.size - 1] == SUBMIT]
+            while not self.frames.empty():
+                frame = self.frames.get_nowait()
+                if frame is not None and frame[FRAME_HEADER.size - 1] == SUBMIT:
+                    unsent.append(frame)
+            with self.lock:
+                self.held.extendleft(reversed(unsent))
+
+    def close(self):
+        self.closed = True
+        self.frames.put(None)
+
+
+class SocketBackplane:
+    # Full mesh of TCP links between server processes, with no broker. Each node tells
+    # every peer which users have their Chat stream on it, keeps the same directory for
+    # the other nodes, and forwards messages for remote users to the node that holds
+    # them: one DELIVER frame per node and message, however many recipients it has
+    # there. Group messages go to every node as one GROUP_DELIVER frame, and each node
+    # fans them out to its own online members, so no node walks a group's full member
+    # list. Each group is numbered by one owner node, which the others SUBMIT its
+    # messages to (see group_owner). Membership changes are broadcast so every node drops
+    # its cached copy.
+    #
+    # Owners never move: while a group's owner is down or unreachable, its messages are
+    # held on the link to it and numbered once it is back (up to PeerLink's max_pending;
+    # past that they are dropped, and the senders' clients resend them when they next
+    # reconnect). Two nodes never number the same group, so its seqs can't repeat.
+    #
+    # node_address is host:port (or unix:/path) this node listens on and doubles as its
+    # id; peers are the addresses of all other nodes. A node only accepts links from peers
+    # that answer its challenge with an HMAC under the shared secret (CHAT_SESSION_SECRET
+    # by default); anything else is closed before a single frame is processed.
+    def __init__(self, node_address, peers, secret=None):
+        self.node_address = node_address
+        self.secret = secret or backplane_secret()
+        self.links = {address: PeerLink(address, node_address, self.secret)
+                      for address in peers if address != node_address}
+        # Every node must be given the same set of addresses, so they agree on group owners
+        self.ring = sorted([node_address, *self.links])
+        self.lock = threading.Lock()
+        self.locations = {}  # username -> (node id holding their stream, inbound socket from that node)
+        self.node = None
+        self.closed = False
+        self.listener = None
+
+    def start(self, node):
+        # node provides local_usernames(), deliver_local(usernames, payload),
+        # deliver_group_local(group_id, payload), publish_forwarded(payload),
+        # replaced_remotely(username) and invalidate_group(group_id)
+        self.node = node
+        self.listener = listen(self.node_address)
+        threading.Thread(target=self.accept_loop, name="backplane-accept", daemon=True).start()
+        for link in self.links.values():
+            link.on_connect = self.presence_snapshot
+            link.thread.start()
+        log.info("backplane listening", node=self.node_address, peers=",".join(self.links) or "none")
+
+    def presence_snapshot(self):
+        names = list(self.node.local_usernames())
+        # Presence frames carry at most 65535 names each
+        return [(PRESENCE, encode_names(names[i:i + 65535])) for i in range(0, len(names), 65535)]
+
+    def broadcast(self, kind, body):
+        for link in self.links.values():
+            link.send(kind, body)
+
+    def user_online(self, username):
+        self.broadcast(ONLINE, encode_names([username]))
+
+    def user_offline(self, username):
+        self.broadcast(OFFLINE, encode_names([username]))
+
+    def forward(self, usernames, payload):
+        by_node = {}
+        with self.lock:
+            for username in usernames:
+                location = self.locations.get(username)
+                if location is not None:
+                    by_node.setdefault(location[0], []).append(username)
+        forwarded = []
+        for node_id, names in by_node.items():
+            link = self.links.get(node_id)
+            if link is not None and link.send(DELIVER, encode_names(names) + payload):
+                forwarded.extend(names)
+        return forwarded
+
+    def forward_group(self, group_id, payload):
+        self.broadcast(GROUP_DELIVER, GROUP_ID.pack(group_id) + payload)
+
+    def group_owner(self, group_id):
+        # The node that numbers the group's messages, so seqs need no shared counter: the
+        # group id picks it from the sorted node list. It depends on nothing else, so every
+        # node agrees on it whatever state their links are in. Returns None when it is this node.
+        address = self.ring[group_id % len(self.ring)]
+        return None if address == self.node_address else address
+
+    def submit(self, node_id, payload):
+        # Held while the owner is unreachable, see above
+        return self.links[node_id].hold(SUBMIT, payload)
+
+    def invalidate_group(self, group_id):
+        self.broadcast(INVALIDATE, GROUP_ID.pack(group_id))
+
+    def accept_loop(self):
+        while not self.closed:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.read_loop, args=(sock,), daemon=True).start()
+
+    def read_loop(self, sock):
+        # Inbound side of a peer's link: everything that node publishes arrives here
+        node_id = None
+        try:
+            node_id = self.authenticate(sock)
+            if node_id is None:
+                return
+            while True:
+                length, kind = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+                body = recv_exact(sock, length)
+                if kind in (PRESENCE, ONLINE):
+                    names, _ = decode_names(body)
+                    with self.lock:
+                        for name in names:
+                            self.locations[name] = (node_id, sock)
+                    if kind == ONLINE:
+                        # A reconnect elsewhere replaces the user's stream here, as it does locally
+                        for name in names:
+                            self.node.replaced_remotely(name)
+                elif kind == OFFLINE:
+                    names, _ = decode_names(body)
+                    with self.lock:
+                        for name in names:
+                            # The user may already have reconnected to another node
+                            location = self.locations.get(name)
+                            if location is not None and location[0] == node_id:
+                                del self.locations[name]
+                elif kind == DELIVER:
+                    names, offset = decode_names(body)
+                    self.node.deliver_local(names, body[offset:])
+                elif kind == GROUP_DELIVER:
+                    (group_id,) = GROUP_ID.unpack_from(body)
+                    self.node.deliver_group_local(group_id, body[GROUP_ID.size:])
+                elif kind == SUBMIT:
+                    self.node.publish_forwarded(body)
+                elif kind == INVALIDATE:
+                    (group_id,) = GROUP_ID.unpack(body)
+                    self.node.invalidate_group(group_id)
+        except (OSError, ConnectionError, struct.error) as e:
+            if not self.closed:
+                log.warning("backplane peer disconnected", peer=node_id, error=e)
+        finally:
+            sock.close()
+            # Whoever was on that node is unreachable until it reconnects and resends presence.
+            # Entries already re-announced over a newer connection from the same node are kept.
+            with self.lock:
+                for name in [n for n, location in self.locations.items() if location[1] is sock]:
+                    del self.locations[name]
+
+    def authenticate(self, sock):
+        # Challenge-response, so a recorded HELLO is no good on another connection. Returns
+        # the peer's node id, or None if it doesn't know the secret
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        challenge = os.urandom(CHALLENGE_SIZE)
+        sock.sendall(challenge)
+        length, kind = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+        if kind != HELLO or not MAC_SIZE < length <= MAX_HELLO_SIZE:
+            log.warning("backplane peer rejected", reason="no hello")
+            return None
+        body = recv_exact(sock, length)
+        node_id = body[MAC_SIZE:].decode(errors="replace")
+        if not hmac.compare_digest(body[:MAC_SIZE], hello_mac(self.secret, challenge, node_id)):
+            log.warning("backplane peer rejected", peer=node_id, reason="bad secret")
+            return None
+        sock.settimeout(None)
+        return node_id
+
+    def stats(self):
+        with self.lock:
+            remote_users = len(self.locations)
+        return {
+            'remote_users': remote_users,
+            'peers_connected': sum(link.connected for link in self.links.values()),
+            'dropped_frames': sum(link.dropped for link in self.links.values()),
+        }
+
+    def close(self):
+        self.closed = True
+        if self.listener is not None:
+            self.listener.close()
+        for link in self.links.values():
+            link.close()
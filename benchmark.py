@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import secrets
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+
+# Headless load generator for ChatService: registers simulated users, builds groups,
+# holds one Chat stream per user and publishes group messages at a fixed rate, then
+# reports throughput and end-to-end delivery latency. Each message carries its send
+# time (time.time_ns) in the content, so latency is measured on the receiving stream.
+
+BENCH_PREFIX = "bench:"
+SESSION_METADATA_KEY = "x-session-token"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_server(port, mode, store, db_path, max_workers, quiet, node_address=None, peers=()):
+    # Child process entry point for a local server under test. store is a storage backend
+    # name; db_path is the SQLite file for "sqlite", shared by several local nodes.
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    from logs import setup_logging
+    setup_logging("WARNING" if quiet else None)
+    import server
+    from backplane import SocketBackplane
+    from storage import open_storage
+
+    storage = open_storage(store, path=db_path)
+    backplane = SocketBackplane(node_address, peers) if node_address else None
+    try:
+        if mode == "aio":
+            asyncio.run(server.serve_async(server.AsyncChatServicer(storage=storage, backplane=backplane), port))
+        else:
+            server.serve(server.ChatServicer(storage=storage, backplane=backplane), port, max_workers=max_workers)
+    except KeyboardInterrupt:
+        pass
+
+
+def start_servers(args):
+    # One local server, or a mesh of args.nodes servers joined by the socket backplane.
+    # Several nodes need one database between them, so "memory" becomes a shared SQLite file.
+    store = args.store
+    if args.nodes > 1 and store == "memory":
+        store = "sqlite"
+    db_path = None
+    if store == "sqlite":
+        db_path = os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "chat.sqlite3")
+        # Create the schema (and switch to WAL) once, before the nodes race to do it
+        from storage import SQLiteStorage
+        SQLiteStorage(db_path).close()
+    # Nodes authenticate each other (and each other's session tokens) with a shared secret
+    if args.nodes > 1:
+        os.environ.setdefault("CHAT_SESSION_SECRET", secrets.token_hex(32))
+    ports = [free_port() for _ in range(args.nodes)]
+    node_addresses = [f"127.0.0.1:{free_port()}" for _ in range(args.nodes)] if args.nodes > 1 else [None]
+    # Every Chat stream holds a worker in thread mode, so leave room for unary RPCs
+    max_workers = args.users + 20
+    processes = []
+    for port, node_address in zip(ports, node_addresses):
+        peers = [address for address in node_addresses if address and address != node_address]
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_server,
+            # Not a daemon: the server starts its own password-hashing worker processes
+            args=(port, args.server_mode, store, db_path, max_workers, not args.server_log, node_address, peers)
+        )
+        process.start()
+        processes.append(process)
+    return [f"127.0.0.1:{port}" for port in ports], processes
+
+
+def group_sizes(num_groups, num_users, size_range, distribution, rng):
+    low, high = size_range
+    high = min(high, num_users)
+    low = min(low, high)
+    sizes = []
+    for rank in range(1, num_groups + 1):
+        if distribution == "zipf":
+            # A few large groups and a long tail of small ones
+            size = int(high / rank)
+        else:
+            size = rng.randint(low, high)
+        sizes.append(max(low, size))
+    return sizes
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class SimUser:
+    def __init__(self, name, stub):
+        self.name = name
+        self.stub = stub
+        self.outbox = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.metadata = ()  # session token from Login
+
+    def login(self, token):
+        self.metadata = ((SESSION_METADATA_KEY, token),)
+
+    async def requests(self):
+        # The opening heartbeat registers the stream; after that only real messages are sent
+        yield chat_pb2.ChatMessage(sender=self.name, content="", type=chat_pb2.HEARTBEAT)
+        while True:
+            message = await self.outbox.get()
+            if message is None:
+                return
+            yield message
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []  # milliseconds
+        self.sent = 0
+        self.expected = 0
+
+    def record(self, content):
+        sent_ns = int(content.split(":", 3)[2])
+        self.latencies.append((time.time_ns() - sent_ns) / 1e6)
+
+
+async def setup_users(stubs, count, password, prefix, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    users = [SimUser(f"{prefix}{i}", stubs[i % len(stubs)]) for i in range(count)]
+
+    async def register(user):
+        async with limit:
+            response = await user.stub.Register(chat_pb2.RegisterRequest(username=user.name, password=password))
+            if not response.success and response.message != "Username already exists":
+                raise RuntimeError(f"Register {user.name} failed: {response.message}")
+            response = await user.stub.Login(chat_pb2.LoginRequest(username=user.name, password=password))
+            if not response.success:
+                raise RuntimeError(f"Login {user.name} failed: {response.message}")
+            user.login(response.session_token)
+
+    await asyncio.gather(*(register(user) for user in users))
+    return users
+
+
+async def setup_groups(users, sizes, rng, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    groups = []
+    for index, size in enumerate(sizes):
+        members = rng.sample(users, size)
+        creator = members[0]
+        response = await creator.stub.CreateGroup(chat_pb2.CreateGroupRequest(
+            group_name=f"bench-group-{index}", creator=creator.name), metadata=creator.metadata)
+        if not response.success:
+            raise RuntimeError(f"CreateGroup failed: {response.message}")
+
+        async def join(user, group_id=response.group_id):
+            async with limit:
+                result = await user.stub.JoinGroup(
+                    chat_pb2.JoinGroupRequest(group_id=group_id, username=user.name), metadata=user.metadata)
+                if not result.success:
+                    raise RuntimeError(f"JoinGroup {user.name} failed: {result.message}")
+
+        await asyncio.gather(*(join(user) for user in members[1:]))
+        groups.append((response.group_id, members))
+    return groups
+
+
+async def receive(user, recorder):
+    try:
+        async for message in user.stub.Chat(user.requests(), metadata=user.metadata):
+            if message.sender == "System":
+                if message.content == "Connected to chat server":
+                    user.connected.set()
+                continue
+            if message.content.startswith(BENCH_PREFIX):
+                recorder.record(message.content)
+    except grpc.aio.AioRpcError as e:
+        if e.code() != grpc.StatusCode.CANCELLED:
+            print(f"Stream for {user.name} failed: {e.code()} {e.details()}")
+
+
+async def publish(groups, rate, duration, message_size, recorder, rng):
+    padding = "x" * max(0, message_size)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    while True:
+        elapsed = loop.time() - start
+        if elapsed >= duration:
+            break
+        due = int(elapsed * rate) + 1
+        while recorder.sent < due:
+            group_id, members = rng.choice(groups)
+            sender = rng.choice(members)
+            content = f"{BENCH_PREFIX}{recorder.sent}:{time.time_ns()}:{padding}"
+            sender.outbox.put_nowait(chat_pb2.ChatMessage(
+                sender=sender.name, content=content, type=chat_pb2.GROUP, group_id=group_id))
+            recorder.sent += 1
+            recorder.expected += len(members) - 1
+        await asyncio.sleep(min(1.0 / rate, 0.01))
+    return loop.time() - start
+
+
+async def run_benchmark(targets, args):
+    rng = random.Random(args.seed)
+    # Users are spread round-robin over the targets (and channels to each target)
+    channels = [grpc.aio.insecure_channel(target) for _ in range(args.channels) for target in targets]
+    await asyncio.wait_for(asyncio.gather(*(channel.channel_ready() for channel in channels)), timeout=30)
+    stubs = [chat_pb2_grpc.ChatServiceStub(channel) for channel in channels]
+
+    prefix = f"bench{os.getpid()}_"
+    print(f"Setting up {args.users} users and {args.groups} groups on {', '.join(targets)}...")
+    users = await setup_users(stubs, args.users, "benchpass", prefix, args.setup_concurrency)
+    sizes = group_sizes(args.groups, args.users, args.group_size, args.distribution, rng)
+    groups = await setup_groups(users, sizes, rng, args.setup_concurrency)
+
+    recorder = Recorder()
+    receivers = [asyncio.create_task(receive(user, recorder)) for user in users]
+    await asyncio.wait_for(asyncio.gather(*(user.connected.wait() for user in users)), timeout=60)
+    if len(targets) > 1:
+        # Presence reaches the other nodes asynchronously
+        await asyncio.sleep(0.5)
+    print(f"{len(users)} Chat streams open, publishing {args.rate} msg/s for {args.duration}s...")
+
+    elapsed = await publish(groups, args.rate, args.duration, args.message_size, recorder, rng)
+    # Let in-flight deliveries land before measuring
+    deadline = time.monotonic() + args.drain
+    while len(recorder.latencies) < recorder.expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+    for user in users:
+        user.outbox.put_nowait(None)
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    for channel in channels:
+        await channel.close()
+
+    report(args, sizes, recorder, elapsed)
+
+
+def report(args, sizes, recorder, elapsed):
+    latencies = sorted(recorder.latencies)
+    delivered = len(latencies)
+    lost = recorder.expected - delivered
+    print()
+    print(f"users: {args.users}  groups: {args.groups}  group size: avg {sum(sizes) / len(sizes):.1f}, max {max(sizes)} ({args.distribution})")
+    print(f"sent: {recorder.sent} in {elapsed:.2f}s = {recorder.sent / elapsed:.1f} msg/s")
+    print(f"delivered: {delivered}/{recorder.expected} ({lost} missing) = {delivered / elapsed:.1f} deliveries/s")
+    print(f"latency ms: p50 {percentile(latencies, 0.50):.2f}  p99 {percentile(latencies, 0.99):.2f}  "
+          f"p999 {percentile(latencies, 0.999):.2f}  max {latencies[-1] if latencies else float('nan'):.2f}")
+
+
+def parse_range(value):
+    low, _, high = value.partition("-")
+    return int(low), int(high or low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-generation and latency benchmark for the chat server")
+    parser.add_argument("--target",
+                        help="host:port of a running server, or a comma-separated list of nodes; by default local servers are started")
+    parser.add_argument("--store", choices=["memory", "sqlite", "mysql"], default="memory",
+                        help="storage backend of the local server: in-memory (default), a fresh SQLite file or the configured MySQL")
+    parser.add_argument("--server-mode", choices=["thread", "aio"], default="aio", help="mode of the local server (default: aio)")
+    parser.add_argument("--nodes", type=int, default=1,
+                        help="local server processes joined by the socket backplane; users are spread across them (default: 1)")
+    parser.add_argument("--server-log", action="store_true", help="show the local server's output")
+    parser.add_argument("--users", type=int, default=50, help="simulated users, one Chat stream each (default: 50)")
+    parser.add_argument("--groups", type=int, default=10, help="number of groups (default: 10)")
+    parser.add_argument("--group-size", type=parse_range, default=(2, 20), help="group size range, e.g. 2-20 (default)")
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform", help="group size distribution")
+    parser.add_argument("--rate", type=float, default=100, help="messages published per second (default: 100)")
+    parser.add_argument("--duration", type=float, default=10, help="publishing time in seconds (default: 10)")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for outstanding deliveries (default: 5)")
+    parser.add_argument("--message-size", type=int, default=32, help="bytes of padding per message (default: 32)")
+    parser.add_argument("--channels", type=int, default=1, help="gRPC channels the users are spread over (default: 1)")
+    parser.add_argument("--setup-concurrency", type=int, default=20, help="concurrent setup RPCs (default: 20)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    processes = []
+    if args.target:
+        targets = [target.strip() for target in args.target.split(",") if target.strip()]
+    else:
+        targets, processes = start_servers(args)
+
+    try:
+        asyncio.run(run_benchmark(targets, args))
+    finally:
+        for process in processes:
+            os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == '__main__':
+    main()
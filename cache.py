@@ -0,0 +1,155 @@
+import threading
+
+
+class ChatCache:
+    # In-process cache for lookups on the message hot path: username -> user id,
+    # group id -> member usernames and group id -> group name. Entries are loaded lazily
+    # through the loader passed by the caller, and membership RPCs update them in place.
+    # Member sets are frozensets that get replaced, never mutated, so callers can iterate
+    # them without holding the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_ids = {}       # username -> user id
+        self.group_members = {}  # group id -> frozenset of usernames
+        self.group_names = {}    # group id -> group name
+        # Bumped on every membership change so a load that raced with a change is not stored
+        self.generations = {}    # group id -> int
+
+    def get_user_id(self, username, loader):
+        with self.lock:
+            user_id = self.user_ids.get(username)
+        if user_id is None:
+            user_id = loader(username)
+            if user_id is not None:
+                with self.lock:
+                    self.user_ids[username] = user_id
+        return user_id
+
+    def set_user_id(self, username, user_id):
+        with self.lock:
+            self.user_ids[username] = user_id
+
+    def get_members(self, group_id, loader):
+        with self.lock:
+            members = self.group_members.get(group_id)
+            generation = self.generations.get(group_id, 0)
+        if members is None:
+            members = frozenset(loader(group_id))
+            with self.lock:
+                if self.generations.get(group_id, 0) == generation:
+                    self.group_members[group_id] = members
+        return members
+
+    def get_group_name(self, group_id, loader):
+        with self.lock:
+            group_name = self.group_names.get(group_id)
+        if group_name is None:
+            group_name = loader(group_id)
+            if group_name is not None:
+                with self.lock:
+                    self.group_names[group_id] = group_name
+        return group_name
+
+    def set_group(self, group_id, group_name, members):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            self.group_names[group_id] = group_name
+            self.group_members[group_id] = frozenset(members)
+
+    def add_member(self, group_id, username):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            members = self.group_members.get(group_id)
+            if members is not None:
+                self.group_members[group_id] = members | {username}
+
+    def remove_member(self, group_id, username):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            members = self.group_members.get(group_id)
+            if members is not None:
+                self.group_members[group_id] = members - {username}
+
+    def invalidate_group(self, group_id):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            self.group_members.pop(group_id, None)
+            self.group_names.pop(group_id, None)
+
+
+class OnlineMembers:
+    # group id -> members of the group whose Chat stream is on this server, so fan-out
+    # touches the online recipients instead of walking every member. A group's entry is
+    # built from its member list the first time it is asked for, then kept current by
+    # stream connects and disconnects and by membership changes; invalidate() drops it.
+    # An entry may briefly hold someone who just left the group, so callers still check
+    # membership of each recipient.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}  # group id -> set of usernames online here
+        self.users = {}  # online username -> ids of their groups
+        # Bumped on every membership change so a build that raced with a change is not stored
+        self.generations = {}  # group id -> int
+        self.changes = 0  # bumped with any of them, for group lists loaded outside the lock
+
+    def get(self, group_id, load_members):
+        with self.lock:
+            online = self.groups.get(group_id)
+            if online is not None:
+                return list(online)
+            generation = self.generations.get(group_id, 0)
+        members = load_members(group_id)
+        with self.lock:
+            # Walk whichever side is smaller: the group or the users online here
+            if len(members) > len(self.users):
+                online = {username for username in self.users if username in members}
+            else:
+                online = {username for username in members if username in self.users}
+            for username in online:
+                self.users[username].add(group_id)
+            if self.generations.get(group_id, 0) == generation:
+                self.groups[group_id] = online
+            return list(online)
+
+    def connect(self, username):
+        with self.lock:
+            self.users.setdefault(username, set())
+
+    def add_groups(self, username, group_ids):
+        with self.lock:
+            user_groups = self.users.get(username)
+            if user_groups is None:
+                return  # not online here
+            for group_id in group_ids:
+                user_groups.add(group_id)
+                online = self.groups.get(group_id)
+                if online is not None:
+                    online.add(username)
+
+    def disconnect(self, username):
+        with self.lock:
+            for group_id in self.users.pop(username, ()):
+                online = self.groups.get(group_id)
+                if online is not None:
+                    online.discard(username)
+
+    def add_member(self, group_id, username):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            self.changes += 1
+        self.add_groups(username, [group_id])
+
+    def remove_member(self, group_id, username):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            self.changes += 1
+            self.users.get(username, set()).discard(group_id)
+            online = self.groups.get(group_id)
+            if online is not None:
+                online.discard(username)
+
+    def invalidate_group(self, group_id):
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            self.changes += 1
+            self.groups.pop(group_id, None)
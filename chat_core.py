@@ -0,0 +1,737 @@
+import asyncio
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+from client_cache import CACHE_DIR, MessageCache
+from logs import get_logger
+
+# UI-free chat client: login, groups, history and the Chat stream with its reconnects.
+# ChatCore is thread based and reports incoming traffic through callbacks; AsyncChatCore
+# is the asyncio flavour and hands out incoming messages through an async iterator.
+# Neither imports tkinter, so bots, load tests and integrations can use them headless:
+#
+#     core = ChatCore()
+#     core.login("alice", "secret")
+#     core.on_message = lambda message: print(message.sender, message.content)
+#     core.start()
+#     core.send(group_id, "hello")
+
+log = get_logger("chat_core")
+
+DEFAULT_TARGET = "localhost:50051"
+SESSION_METADATA_KEY = "x-session-token"
+HISTORY_PAGE_SIZE = 50  # messages shown / fetched per page when a group is opened
+HISTORY_SYNC_MAX_PAGES = 20  # beyond this many new pages the local cache is restarted
+
+# The connection is kept alive (and a dead server detected) with HTTP/2 keepalive pings;
+# the server accepts pings no more often than every 20s
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+APP_HEARTBEAT_INTERVAL = 300  # seconds of silence before an application-level HEARTBEAT is sent
+OUTBOUND_DRAIN_MAX = 100  # queued messages taken per wake-up of the outbound stream
+RECONNECT_DELAY = 1  # seconds before a failed Chat stream is reopened
+GROUP_REFRESH_DELAY = 0.2  # full group list reloads requested within this window are merged
+# Messages written to a stream in this many seconds before it failed are sent again on the
+# next one; the server drops the copies it already has by client_msg_id
+RESEND_WINDOW = 60
+RESEND_MAX = 1000
+
+# Control messages the server sends as "System" on the Chat stream
+SYSTEM_SENDER = "System"
+CONNECTED_CONTENT = "Connected to chat server"
+UPDATE_GROUPS_CONTENT = "UPDATE_GROUPS"
+RESYNC_CONTENT = "RESYNC"
+
+
+class ChatError(Exception):
+    # The server answered success=False; the message is its explanation
+    pass
+
+
+def check(response):
+    if not response.success:
+        raise ChatError(response.message)
+    return response
+
+
+def heartbeat(username, resume=None):
+    # The heartbeat that opens a stream carries resume: group id -> last seq received, and
+    # the server replays whatever came after
+    return chat_pb2.ChatMessage(sender=username, content="", type=chat_pb2.HEARTBEAT, resume=resume)
+
+
+def new_message(username, group_id, content):
+    return chat_pb2.ChatMessage(
+        sender=username,
+        content=content,
+        type=chat_pb2.GROUP,
+        group_id=group_id,
+        client_msg_id=uuid.uuid4().hex
+    )
+
+
+class RecentSends:
+    # Messages written to the Chat stream lately, oldest first. A stream can fail after a
+    # message was written but before the server got it, so a new stream starts with these.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = OrderedDict()  # client_msg_id -> (sent at, message)
+
+    def add(self, message):
+        now = time.monotonic()
+        with self.lock:
+            # A resent message keeps its first send time
+            self.messages.setdefault(message.client_msg_id, (now, message))
+            while self.messages:
+                sent_at, _ = next(iter(self.messages.values()))
+                if now - sent_at < RESEND_WINDOW and len(self.messages) <= RESEND_MAX:
+                    break
+                self.messages.popitem(last=False)
+
+    def pending(self):
+        now = time.monotonic()
+        with self.lock:
+            return [message for sent_at, message in self.messages.values() if now - sent_at < RESEND_WINDOW]
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+
+
+def describe(error):
+    # RpcError's str() is a multi-line dump; its code and details are enough for the log
+    if isinstance(error, grpc.RpcError) and hasattr(error, "code"):
+        return f"{error.code().name}: {error.details()}"
+    return str(error)
+
+
+def changes_membership(message):
+    # Invite and join notices; the group list itself is kept current by GROUP_UPDATE deltas
+    return message.sender == SYSTEM_SENDER and (
+        "invited to group" in message.content or "joined the group" in message.content)
+
+
+class ChatCore:
+    # Callbacks run on the stream's receiver thread; a UI has to hand them over to its own
+    # thread. on_message(message) gets chat messages and system notifications,
+    # on_groups_changed(groups) the new {group_id: group_name} after a full reload,
+    # on_group_update(action, group_id, group_name) a single GroupUpdate delta, on_resync()
+    # fires when the server dropped part of our backlog, and on_disconnect(error) when the
+    # stream failed.
+    def __init__(self, target=DEFAULT_TARGET, channel=None, cache_dir=CACHE_DIR, reconnect=True):
+        self.channel = channel or grpc.insecure_channel(target, options=CHANNEL_OPTIONS)
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+        self.cache_dir = cache_dir  # None keeps no local history cache
+        self.reconnect_enabled = reconnect
+
+        self.username = None
+        self.session_token = ""  # issued by Login, sent as metadata on every later RPC
+        self.groups = {}  # group_id -> group_name
+        self.last_seqs = {}  # group_id -> highest seq received, sent when the stream reopens
+        self.message_cache = None  # local history cache, opened on login
+
+        self.message_queue = queue.Queue()  # outbound messages for the Chat stream
+        self.recent_sends = RecentSends()  # resent when the stream reopens
+        self.receiver_thread = None
+        self.call = None  # the open Chat call
+        self.stream_end = None
+        self.is_running = False
+        self.refresh_lock = threading.Lock()
+        self.refresh_timer = None  # pending debounced group list reload
+        self.tasks = queue.Queue()  # (func, args, on_done) for the worker thread, see run_later
+        self.worker_thread = None
+
+        self.on_message = None
+        self.on_groups_changed = None
+        self.on_group_update = None
+        self.on_resync = None
+        self.on_disconnect = None
+
+    def notify(self, callback, *args):
+        if callback is not None:
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("error in client callback")
+
+    def auth_metadata(self):
+        return ((SESSION_METADATA_KEY, self.session_token),)
+
+    # Account
+
+    def register(self, username, password):
+        return check(self.stub.Register(chat_pb2.RegisterRequest(username=username, password=password))).message
+
+    def login(self, username, password):
+        response = check(self.stub.Login(chat_pb2.LoginRequest(username=username, password=password)))
+        self.username = username
+        self.session_token = response.session_token
+        if self.cache_dir is not None:
+            self.message_cache = MessageCache(username, self.cache_dir)
+        return response.message
+
+    def logout(self):
+        self.stop()
+        with self.refresh_lock:
+            if self.refresh_timer is not None:
+                self.refresh_timer.cancel()
+                self.refresh_timer = None
+        if self.message_cache:
+            self.message_cache.close()
+            self.message_cache = None
+        self.username = None
+        self.session_token = ""
+        self.groups = {}
+        self.last_seqs = {}
+        self.recent_sends.clear()
+        # Drop whatever was never sent
+        while True:
+            try:
+                self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def close(self):
+        self.logout()
+        self.channel.close()
+
+    # Groups
+
+    def refresh_groups(self):
+        response = check(self.stub.GetUserGroups(chat_pb2.GetUserGroupsRequest(
+            username=self.username
+        ), metadata=self.auth_metadata()))
+        self.groups = {group.group_id: group.group_name for group in response.groups}
+        # Groups with nothing received yet resume from their seq as of now, so messages
+        # sent to a quiet group while the stream is down are replayed too
+        for group in response.groups:
+            self.last_seqs.setdefault(group.group_id, group.last_seq)
+        self.notify(self.on_groups_changed, dict(self.groups))
+        return self.groups
+
+    def request_group_refresh(self):
+        # Reloads the group list on a timer thread, never the caller's; requests that
+        # arrive while one is pending are merged into it
+        with self.refresh_lock:
+            if self.refresh_timer is not None:
+                return
+            self.refresh_timer = threading.Timer(GROUP_REFRESH_DELAY, self.run_group_refresh)
+            self.refresh_timer.daemon = True
+            self.refresh_timer.start()
+
+    def run_later(self, func, *args, on_done=None):
+        # Runs func(*args) on the core's worker thread, one call at a time, then on_done(result)
+        # on that thread too, so a UI can keep RPCs and cache reads off its own thread
+        with self.refresh_lock:
+            if self.worker_thread is None:
+                self.worker_thread = threading.Thread(target=self.run_tasks, name="chat-worker", daemon=True)
+                self.worker_thread.start()
+        self.tasks.put((func, args, on_done))
+
+    def run_tasks(self):
+        while True:
+            func, args, on_done = self.tasks.get()
+            try:
+                result = func(*args)
+            except Exception:
+                log.exception("error in background task")
+                continue
+            self.notify(on_done, result)
+
+    def run_group_refresh(self):
+        with self.refresh_lock:
+            self.refresh_timer = None
+        if not self.session_token:
+            return
+        try:
+            self.refresh_groups()
+        except (ChatError, grpc.RpcError) as e:
+            log.error("error loading groups", error=describe(e))
+
+    def apply_group_update(self, action, group_id, group_name="", last_seq=0):
+        # Patches the group list with one delta; repeats of a delta already applied (our own
+        # change echoed by the server) are ignored
+        groups = dict(self.groups)
+        if action == chat_pb2.GroupUpdate.REMOVED:
+            self.last_seqs.pop(group_id, None)
+            if groups.pop(group_id, None) is None:
+                return
+        else:
+            if action == chat_pb2.GroupUpdate.ADDED:
+                self.last_seqs.setdefault(group_id, last_seq)
+            if groups.get(group_id) == group_name:
+                return
+            groups[group_id] = group_name
+        self.groups = groups
+        self.notify(self.on_group_update, action, group_id, group_name)
+
+    def create_group(self, group_name):
+        response = check(self.stub.CreateGroup(chat_pb2.CreateGroupRequest(
+            creator=self.username,
+            group_name=group_name
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.ADDED, response.group_id, group_name)
+        return response.group_id
+
+    def join_group(self, group_id):
+        response = check(self.stub.JoinGroup(chat_pb2.JoinGroupRequest(
+            username=self.username,
+            group_id=group_id
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.ADDED, group_id, response.group_name, response.last_seq)
+
+    def leave_group(self, group_id):
+        check(self.stub.LeaveGroup(chat_pb2.LeaveGroupRequest(
+            username=self.username,
+            group_id=group_id
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.REMOVED, group_id)
+
+    def invite_user(self, group_id, invitee):
+        if invitee == self.username:
+            raise ChatError("You cannot invite yourself")
+        return check(self.stub.InviteUser(chat_pb2.InviteUserRequest(
+            group_id=group_id,
+            inviter=self.username,
+            invitee=invitee
+        ), metadata=self.auth_metadata())).message
+
+    # History
+
+    def fetch_history(self, group_id, limit=HISTORY_PAGE_SIZE, before_id=0, after_id=0):
+        # One page straight from the server, oldest first; returns (messages, has_more)
+        response = check(self.stub.GetGroupHistory(chat_pb2.GetGroupHistoryRequest(
+            group_id=group_id,
+            before_id=before_id,
+            after_id=after_id,
+            limit=limit
+        ), metadata=self.auth_metadata()))
+        return list(response.messages), response.has_more
+
+    def cached_history(self, group_id, limit=HISTORY_PAGE_SIZE):
+        # Newest cached messages, oldest first, as (id, sender, content, timestamp)
+        return self.message_cache.recent(group_id, limit)
+
+    def older_history(self, group_id, before_id, limit=HISTORY_PAGE_SIZE):
+        # The page before before_id, oldest first as (id, sender, content, timestamp), and
+        # whether there may be more. Served from the cache as far as it reaches; the rest
+        # comes from the server and extends the cache downwards, which keeps it contiguous.
+        rows = self.message_cache.before(group_id, before_id, limit) if self.message_cache else []
+        if len(rows) == limit:
+            return rows, True
+        cursor = rows[0][0] if rows else before_id
+        try:
+            messages, has_more = self.fetch_history(group_id, limit=limit - len(rows), before_id=cursor)
+        except ChatError:
+            return rows, False
+        if self.message_cache and messages:
+            self.message_cache.add(group_id, messages)
+        return [(m.id, m.sender, m.content, m.timestamp) for m in messages] + rows, has_more
+
+    def sync_history(self, group_id):
+        # Pulls messages newer than the cache's last id; returns True if the cache changed
+        last_id = self.message_cache.last_id(group_id)
+        changed = False
+        if last_id:
+            for _ in range(HISTORY_SYNC_MAX_PAGES):
+                try:
+                    messages, has_more = self.fetch_history(group_id, after_id=last_id)
+                except ChatError:
+                    return changed
+                if messages:
+                    self.message_cache.add(group_id, messages)
+                    last_id = messages[-1].id
+                    changed = True
+                if not has_more:
+                    return changed
+            # Too far behind to catch up page by page: restart the cache from the newest page
+            self.message_cache.clear_group(group_id)
+
+        try:
+            messages, _ = self.fetch_history(group_id)
+        except ChatError:
+            return True
+        self.message_cache.add(group_id, messages)
+        return True
+
+    # Chat stream
+
+    def send(self, group_id, content):
+        if group_id not in self.groups:
+            raise ChatError("You are not a member of this group")
+        message = new_message(self.username, group_id, content)
+        self.message_queue.put(message)
+        return message
+
+    def start(self):
+        self.is_running = True
+        # Queued to wake up this stream's request generator and end it
+        self.stream_end = object()
+        # The opening heartbeat registers the stream with the server; after a reconnect it
+        # also asks for the messages missed in between, and the messages that may have been
+        # lost with the old stream go out again before anything new
+        opening = [heartbeat(self.username, dict(self.last_seqs))] + self.recent_sends.pending()
+        self.receiver_thread = threading.Thread(target=self.receive_messages,
+                                                args=(self.username, self.stream_end, opening),
+                                                name="chat-receiver", daemon=True)
+        self.receiver_thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.receiver_thread:
+            # Ending the outbound side closes the stream; cancelling also ends a call that
+            # is still waiting for the server to come back
+            self.message_queue.put(self.stream_end)
+            if self.call is not None:
+                self.call.cancel()
+            if self.receiver_thread is not threading.current_thread():
+                self.receiver_thread.join(timeout=1.0)
+            self.receiver_thread = None
+
+    def reconnect(self):
+        try:
+            if not self.is_running and self.session_token:
+                log.info("attempting to reconnect")
+                self.start()
+        except Exception:
+            log.exception("error reconnecting")
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        timer = threading.Timer(RECONNECT_DELAY, self.reconnect)
+        timer.daemon = True
+        timer.start()
+
+    def receive_messages(self, username, stream_end, opening=()):
+        try:
+            log.info("starting message receiver", user=username)
+            # wait_for_ready: while the server is down the call waits for the channel to
+            # reconnect instead of failing at once, so reconnects don't spin
+            self.call = self.stub.Chat(self.generate_messages(username, stream_end, opening), metadata=self.auth_metadata(),
+                                       wait_for_ready=True)
+            for message in self.call:
+                try:
+                    log.sampled("message received", sender=message.sender, group_id=message.group_id)
+                    if message.seq > self.last_seqs.get(message.group_id, 0):
+                        self.last_seqs[message.group_id] = message.seq
+                    self.handle_message(message)
+                except Exception:
+                    log.exception("error processing received message")
+
+        except Exception as e:
+            if not self.is_running:
+                return  # stopped on purpose
+            log.error("message receiver stopped", error=describe(e))
+            self.is_running = False
+            if "Stream removed" not in str(e):  # Ignore normal stream closure
+                self.notify(self.on_disconnect, e)
+                if self.reconnect_enabled:
+                    self.schedule_reconnect()
+        finally:
+            # The generator may still be waiting on the queue
+            self.message_queue.put(stream_end)
+
+    def handle_message(self, message):
+        # Xử lý tin nhắn hệ thống
+        if message.sender == SYSTEM_SENDER:
+            if message.type == chat_pb2.GROUP_UPDATE:
+                update = message.group_update
+                self.apply_group_update(update.action, message.group_id, update.group_name, update.last_seq)
+                return
+
+            if message.content == CONNECTED_CONTENT:
+                log.info("connected to chat server")
+                return
+
+            if message.content == UPDATE_GROUPS_CONTENT:
+                # Sent when the stream opens, to catch up on deltas missed while disconnected
+                log.debug("updating groups list")
+                self.request_group_refresh()
+                return
+
+            if message.content == RESYNC_CONTENT:
+                # The server dropped our backlog because we fell behind; reload from history
+                log.warning("resyncing after dropped messages")
+                self.request_group_refresh()
+                self.notify(self.on_resync)
+                return
+
+        if message.content:
+            self.notify(self.on_message, message)
+
+    def generate_messages(self, username, stream_end, opening=()):
+        for message in opening:
+            if message.client_msg_id:
+                self.recent_sends.add(message)
+            yield message
+        last_sent = time.monotonic()
+        while self.is_running:
+            try:
+                # Sleep until something is queued or the next heartbeat is due
+                wait = APP_HEARTBEAT_INTERVAL - (time.monotonic() - last_sent)
+                try:
+                    pending = [self.message_queue.get(timeout=max(wait, 0))]
+                except queue.Empty:
+                    # Keepalive pings hold the stream open; this is only a rare sign of life
+                    # for proxies that watch for application data
+                    yield heartbeat(username)
+                    last_sent = time.monotonic()
+                    continue
+
+                # Take whatever else is already queued as well, so a burst goes out back to back
+                while len(pending) < OUTBOUND_DRAIN_MAX:
+                    try:
+                        pending.append(self.message_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for index, message in enumerate(pending):
+                    if message is stream_end:
+                        # Anything queued after the end marker belongs to the next stream
+                        for later in pending[index + 1:]:
+                            self.message_queue.put(later)
+                        return
+                    # Skips the end markers of earlier streams
+                    if isinstance(message, chat_pb2.ChatMessage):
+                        log.sampled("sending message", group_id=message.group_id)
+                        if message.client_msg_id:
+                            self.recent_sends.add(message)
+                        yield message
+                last_sent = time.monotonic()
+            except Exception:
+                log.exception("error in generate_messages")
+
+
+class AsyncChatCore:
+    # asyncio flavour with the same operations. Incoming chat messages and system
+    # notifications come out of messages(); a RESYNC notification (content RESYNC_CONTENT)
+    # means the server dropped part of our backlog and history should be reloaded. GROUP_UPDATE
+    # messages are applied to groups before they are handed out. There is
+    # no local history cache here, since SQLite would block the event loop.
+    #
+    #     core = AsyncChatCore()
+    #     await core.login("alice", "secret")
+    #     core.start()
+    #     async for message in core.messages():
+    #         ...
+    def __init__(self, target=DEFAULT_TARGET, channel=None, reconnect=True):
+        self.channel = channel or grpc.aio.insecure_channel(target, options=CHANNEL_OPTIONS)
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+        self.reconnect_enabled = reconnect
+
+        self.username = None
+        self.session_token = ""
+        self.groups = {}  # group_id -> group_name
+        self.last_seqs = {}  # group_id -> highest seq received, sent when the stream reopens
+
+        self.outbound = None  # asyncio.Queue of messages for the Chat stream, created by start()
+        self.recent_sends = RecentSends()  # resent when the stream reopens
+        self.inbound = None  # asyncio.Queue feeding messages(); None marks the end of the stream
+        self.stream_task = None
+        self.call = None  # the open Chat call
+        self.is_running = False
+
+    def auth_metadata(self):
+        return ((SESSION_METADATA_KEY, self.session_token),)
+
+    async def register(self, username, password):
+        return check(await self.stub.Register(chat_pb2.RegisterRequest(username=username, password=password))).message
+
+    async def login(self, username, password):
+        response = check(await self.stub.Login(chat_pb2.LoginRequest(username=username, password=password)))
+        self.username = username
+        self.session_token = response.session_token
+        return response.message
+
+    async def logout(self):
+        await self.stop()
+        self.username = None
+        self.session_token = ""
+        self.groups = {}
+        self.last_seqs = {}
+        self.recent_sends.clear()
+
+    async def close(self):
+        await self.logout()
+        await self.channel.close()
+
+    async def refresh_groups(self):
+        response = check(await self.stub.GetUserGroups(chat_pb2.GetUserGroupsRequest(
+            username=self.username
+        ), metadata=self.auth_metadata()))
+        self.groups = {group.group_id: group.group_name for group in response.groups}
+        # Groups with nothing received yet resume from their seq as of now, so messages
+        # sent to a quiet group while the stream is down are replayed too
+        for group in response.groups:
+            self.last_seqs.setdefault(group.group_id, group.last_seq)
+        return self.groups
+
+    def apply_group_update(self, action, group_id, group_name="", last_seq=0):
+        # Returns whether the delta changed anything
+        if action == chat_pb2.GroupUpdate.REMOVED:
+            self.last_seqs.pop(group_id, None)
+            return self.groups.pop(group_id, None) is not None
+        if action == chat_pb2.GroupUpdate.ADDED:
+            self.last_seqs.setdefault(group_id, last_seq)
+        if self.groups.get(group_id) == group_name:
+            return False
+        self.groups[group_id] = group_name
+        return True
+
+    async def create_group(self, group_name):
+        response = check(await self.stub.CreateGroup(chat_pb2.CreateGroupRequest(
+            creator=self.username,
+            group_name=group_name
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.ADDED, response.group_id, group_name)
+        return response.group_id
+
+    async def join_group(self, group_id):
+        response = check(await self.stub.JoinGroup(chat_pb2.JoinGroupRequest(
+            username=self.username,
+            group_id=group_id
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.ADDED, group_id, response.group_name, response.last_seq)
+
+    async def leave_group(self, group_id):
+        check(await self.stub.LeaveGroup(chat_pb2.LeaveGroupRequest(
+            username=self.username,
+            group_id=group_id
+        ), metadata=self.auth_metadata()))
+        self.apply_group_update(chat_pb2.GroupUpdate.REMOVED, group_id)
+
+    async def invite_user(self, group_id, invitee):
+        if invitee == self.username:
+            raise ChatError("You cannot invite yourself")
+        return check(await self.stub.InviteUser(chat_pb2.InviteUserRequest(
+            group_id=group_id,
+            inviter=self.username,
+            invitee=invitee
+        ), metadata=self.auth_metadata())).message
+
+    async def fetch_history(self, group_id, limit=HISTORY_PAGE_SIZE, before_id=0, after_id=0):
+        response = check(await self.stub.GetGroupHistory(chat_pb2.GetGroupHistoryRequest(
+            group_id=group_id,
+            before_id=before_id,
+            after_id=after_id,
+            limit=limit
+        ), metadata=self.auth_metadata()))
+        return list(response.messages), response.has_more
+
+    async def send(self, group_id, content):
+        if group_id not in self.groups:
+            raise ChatError("You are not a member of this group")
+        message = new_message(self.username, group_id, content)
+        await self.outbound.put(message)
+        return message
+
+    def start(self):
+        self.is_running = True
+        self.outbound = asyncio.Queue()
+        self.inbound = asyncio.Queue()
+        self.stream_task = asyncio.create_task(self.run_stream())
+
+    async def stop(self):
+        self.is_running = False
+        if self.stream_task is not None:
+            self.outbound.put_nowait(None)
+            if self.call is not None:
+                self.call.cancel()
+            try:
+                await asyncio.wait_for(self.stream_task, 1.0)
+            except asyncio.TimeoutError:
+                pass
+            self.stream_task = None
+
+    async def messages(self):
+        while True:
+            message = await self.inbound.get()
+            if message is None:
+                return
+            yield message
+
+    async def run_stream(self):
+        try:
+            while self.is_running:
+                try:
+                    log.info("starting message receiver", user=self.username)
+                    self.call = self.stub.Chat(self.generate_messages(), metadata=self.auth_metadata(),
+                                               wait_for_ready=True)
+                    async for message in self.call:
+                        try:
+                            log.sampled("message received", sender=message.sender, group_id=message.group_id)
+                            if message.seq > self.last_seqs.get(message.group_id, 0):
+                                self.last_seqs[message.group_id] = message.seq
+                            await self.handle_message(message)
+                        except Exception:
+                            log.exception("error processing received message")
+                    break
+                except asyncio.CancelledError:
+                    if self.is_running:
+                        raise
+                    break  # the call was cancelled by stop()
+                except Exception as e:
+                    # Not only RPC errors: whatever ends the stream, reopen it and resume
+                    log.error("message receiver stopped", error=describe(e))
+                    if not self.is_running or not self.reconnect_enabled:
+                        break
+                    await asyncio.sleep(RECONNECT_DELAY)
+                    log.info("attempting to reconnect")
+        finally:
+            self.is_running = False
+            self.inbound.put_nowait(None)
+
+    async def handle_message(self, message):
+        if message.sender == SYSTEM_SENDER:
+            if message.type == chat_pb2.GROUP_UPDATE:
+                update = message.group_update
+                if self.apply_group_update(update.action, message.group_id, update.group_name, update.last_seq):
+                    self.inbound.put_nowait(message)
+                return
+            if message.content == CONNECTED_CONTENT:
+                log.info("connected to chat server")
+                return
+            if message.content == UPDATE_GROUPS_CONTENT:
+                await self.refresh_groups()
+                return
+            if message.content == RESYNC_CONTENT:
+                await self.refresh_groups()
+        if message.content:
+            self.inbound.put_nowait(message)
+
+    async def generate_messages(self):
+        yield heartbeat(self.username, dict(self.last_seqs))
+        for message in self.recent_sends.pending():
+            yield message
+        last_sent = time.monotonic()
+        while True:
+            wait = APP_HEARTBEAT_INTERVAL - (time.monotonic() - last_sent)
+            try:
+                pending = [await asyncio.wait_for(self.outbound.get(), max(wait, 0))]
+            except asyncio.TimeoutError:
+                yield heartbeat(self.username)
+                last_sent = time.monotonic()
+                continue
+            while len(pending) < OUTBOUND_DRAIN_MAX:
+                try:
+                    pending.append(self.outbound.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            for message in pending:
+                if message is None:
+                    return
+                log.sampled("sending message", group_id=message.group_id)
+                self.recent_sends.add(message)
+                yield message
+            last_sent = time.monotonic()
@@ -1,16 +1,21 @@
-import grpc
+import argparse
+import threading
 import tkinter as tk
+from collections import deque
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import chat_pb2
-import chat_pb2_grpc
-import threading
-import queue
-import time
 from datetime import datetime
 from ttkthemes import ThemedTk
+from chat_core import ChatCore, ChatError, HISTORY_PAGE_SIZE, changes_membership
+from logs import get_logger, setup_logging, shutdown_logging
+
+RENDER_INTERVAL_MS = 16  # incoming messages are drawn at most once per frame
+SCROLLBACK_LINES = 2000  # lines kept in the message display while following new messages
+
+log = get_logger("client")
 
 class ChatClient:
-    def __init__(self):
+    def __init__(self, scrollback=SCROLLBACK_LINES):
         self.window = ThemedTk(theme="arc")  # Modern theme
         self.window.title("Modern Chat Application")
         self.window.geometry("1200x700")
@@ -211,6 +216,14 @@ class ChatClient:
         )
         self.message_display.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
         self.message_display.config(state=tk.DISABLED)
+        self.message_display.tag_configure("timestamp", foreground="#666666")
+        self.message_display.tag_configure("system", foreground="#FF0000", font=("Helvetica", 10, "bold"))
+        self.message_display.tag_configure("system_content", foreground="#FF0000")
+        self.message_display.tag_configure("sender", foreground="#0000FF", font=("Helvetica", 10, "bold"))
+        self.message_display.tag_configure("own_sender", foreground="#008000", font=("Helvetica", 10, "bold"))
+        self.message_display.tag_configure("content", foreground="#000000")
+        # Reaching the top of the scrollback loads older history
+        self.message_display.configure(yscrollcommand=self.on_display_scroll)
         
         # Modern message input frame
         input_frame = ttk.Frame(self.right_panel, style="TFrame")
@@ -240,20 +253,33 @@ class ChatClient:
         self.right_panel.rowconfigure(1, weight=1)
         input_frame.columnconfigure(0, weight=1)
         
-        # Initialize gRPC
-        self.channel = grpc.insecure_channel('localhost:50051')
-        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
-        
-        # Message queue for receiving messages
-        self.message_queue = queue.Queue()
-        
-        # Start message receiver thread
-        self.receiver_thread = None
-        self.is_running = False
-        
+        # All RPCs, the Chat stream and reconnects live in the headless core; its callbacks
+        # arrive on the receiver thread and are handed to the Tk thread here
+        self.core = ChatCore()
+        self.core.on_message = self.queue_incoming
+        self.core.on_groups_changed = lambda groups: self.window.after_idle(self.show_groups, groups)
+        self.core.on_group_update = lambda action, group_id, group_name: self.window.after_idle(
+            self.apply_group_update, action, group_id, group_name)
+        self.core.on_resync = lambda: self.window.after_idle(self.resync)
+        self.core.on_disconnect = lambda error: self.window.after_idle(
+            messagebox.showerror, "Error", f"Connection error: {error}\nTrying to reconnect...")
+
         # Store current group info
         self.current_group = None
-        self.user_groups = {}  # group_id -> group_name
+        self.user_groups = {}  # group_id -> group_name, as shown in the group list
+
+        # Incoming messages wait here (filled by the receiver thread) until the next frame
+        self.pending = deque()  # (ChatMessage, sent by us)
+        self.render_lock = threading.Lock()
+        self.render_scheduled = False
+
+        # What the message display holds, so the scrollback can be trimmed message by message
+        self.scrollback = scrollback
+        self.rendered = deque()  # [history message id or None, line count] per message, oldest first
+        self.rendered_lines = 0
+        self.older_cursor = 0  # id of the oldest history message shown; older pages load before it
+        self.has_older = False
+        self.loading_older = False
         
         # Bind Enter key to send message
         self.message_entry.bind('<Return>', lambda e: self.send_message())
@@ -274,152 +300,252 @@ class ChatClient:
         password = self.password_var.get()
         
         try:
-            response = self.stub.Login(chat_pb2.LoginRequest(username=username, password=password))
-            if response.success:
-                messagebox.showinfo("Success", "Login successful!")
-                self.login_frame.grid_remove()
-                self.chat_frame.grid()
-                self.user_label.config(text=f"Logged in as: {username}")
-                self.start_chat(username)
-                self.load_user_groups()
-            else:
-                messagebox.showerror("Error", response.message)
+            self.core.login(username, password)
+            messagebox.showinfo("Success", "Login successful!")
+            self.login_frame.grid_remove()
+            self.chat_frame.grid()
+            self.user_label.config(text=f"Logged in as: {username}")
+            self.core.start()
+            self.load_user_groups()
+        except ChatError as e:
+            messagebox.showerror("Error", str(e))
         except Exception as e:
             messagebox.showerror("Error", f"Login failed: {str(e)}")
 
-    def start_chat(self, username):
-        self.is_running = True
-        self.receiver_thread = threading.Thread(target=self.receive_messages, args=(username,))
-        self.receiver_thread.daemon = True
-        self.receiver_thread.start()
-        
-        # Send initial connection message
-        initial_message = chat_pb2.ChatMessage(
-            sender=username,
-            content="",
-            type=chat_pb2.HEARTBEAT
-        )
-        self.message_queue.put(initial_message)
+    def queue_incoming(self, message):
+        # Runs on the receiver thread; a burst of messages costs one redraw
+        self.pending.append((message, False))
+        with self.render_lock:
+            if self.render_scheduled:
+                return
+            self.render_scheduled = True
+        self.window.after(RENDER_INTERVAL_MS, self.flush_pending)
 
-    def receive_messages(self, username):
-        try:
-            print(f"Starting message receiver for {username}")
-            for message in self.stub.Chat(self.generate_messages(username)):
-                try:
-                    print(f"Received message: {message.content} from {message.sender}")
-                    
-                    # Xử lý tin nhắn hệ thống
-                    if message.sender == "System":
-                        if message.content == "Connected to chat server":
-                            print("Connected to chat server")
-                            continue
-                            
-                        if message.content == "UPDATE_GROUPS":
-                            print("Updating groups list")
-                            self.window.after(100, self.load_user_groups)
-                            continue
-                    
-                    # Xử lý tin nhắn thông thường
-                    if message.content:
-                        if message.type == chat_pb2.GROUP:
-                            # Nếu là tin nhắn từ group hiện tại
-                            if str(message.group_id) == str(self.current_group):
-                                self.window.after_idle(self.display_message, message)
-                                print(f"Displaying message in chat window: {message.content}")
-                            # Nếu là tin nhắn hệ thống về thay đổi group
-                            elif message.sender == "System" and ("invited to group" in message.content or "joined the group" in message.content):
-                                self.window.after_idle(self.display_message, message)
-                                self.window.after(100, self.load_user_groups)
-                except Exception as e:
-                    print(f"Error processing received message: {e}")
-                    
-        except Exception as e:
-            print(f"Error in message receiver: {e}")
-            if "Stream removed" not in str(e):  # Ignore normal stream closure
-                messagebox.showerror("Error", f"Connection error: {str(e)}\nTrying to reconnect...")
-                self.window.after(1000, self.reconnect)  # Try to reconnect after 1 second
-            self.is_running = False
-
-    def generate_messages(self, username):
-        while self.is_running:
-            try:
-                # Try to get a message from the queue
-                try:
-                    message = self.message_queue.get(block=False)
-                    if message:
-                        print(f"Generating message: {message.content}")
-                        yield message
-                except queue.Empty:
-                    # Send a heartbeat message to keep the stream alive
-                    heartbeat = chat_pb2.ChatMessage(
-                        sender=username,
-                        content="",
-                        type=chat_pb2.HEARTBEAT
-                    )
-                    yield heartbeat
-                    
-                # Add a small delay to prevent CPU overuse
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"Error in generate_messages: {e}")
-                time.sleep(0.1)
+    def flush_pending(self):
+        with self.render_lock:
+            self.render_scheduled = False
+        segments = []
+        entries = []
+        while self.pending:
+            message, own = self.pending.popleft()
+            if not own and not self.is_shown(message):
+                continue
+            segments.extend(self.format_message(message, own))
+            entries.append([None, message.content.count("\n") + 1])
+        if segments:
+            self.append_messages(segments, entries)
+
+    def is_shown(self, message):
+        if message.type != chat_pb2.GROUP:
+            return False
+        # Tin nhắn từ group hiện tại, hoặc tin nhắn hệ thống về thay đổi group
+        return str(message.group_id) == str(self.current_group) or changes_membership(message)
+
+    def format_message(self, message, own=False):
+        # (text, tags) pairs for a single Text.insert call
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        if own:
+            sender, sender_tag, content_tag = "You", "own_sender", "content"
+        elif message.sender == "System":
+            sender, sender_tag, content_tag = "System", "system", "system_content"
+        else:
+            sender, sender_tag, content_tag = message.sender, "sender", "content"
+        return [f"[{timestamp}] ", "timestamp", f"{sender}: ", sender_tag, f"{message.content}\n", content_tag]
+
+    def append_messages(self, segments, entries):
+        display = self.message_display
+        # Only follow new messages (and trim) when the user isn't reading further up
+        following = display.yview()[1] >= 1.0
+        display.config(state=tk.NORMAL)
+        display.insert(tk.END, *segments)
+        self.rendered.extend(entries)
+        self.rendered_lines += sum(lines for _, lines in entries)
+        if following:
+            self.trim_scrollback()
+            display.see(tk.END)
+        display.config(state=tk.DISABLED)
+
+    def trim_scrollback(self):
+        # Drops the oldest messages beyond the scrollback window; they can be loaded again
+        # from history by scrolling up
+        removed_lines = 0
+        removed_ids = []
+        while self.rendered_lines - removed_lines > self.scrollback and len(self.rendered) > 1:
+            message_id, lines = self.rendered.popleft()
+            removed_lines += lines
+            if message_id is not None:
+                removed_ids.append(message_id)
+        if not removed_lines:
+            return
+        self.message_display.delete("1.0", f"{removed_lines + 1}.0")
+        self.rendered_lines -= removed_lines
+        if removed_ids:
+            remaining = next((message_id for message_id, _ in self.rendered if message_id is not None), None)
+            self.older_cursor = remaining if remaining is not None else max(removed_ids) + 1
+            self.has_older = True
+
+    def clear_display(self):
+        self.rendered.clear()
+        self.rendered_lines = 0
+        self.older_cursor = 0
+        self.has_older = False
+        self.message_display.config(state=tk.NORMAL)
+        self.message_display.delete(1.0, tk.END)
+        self.message_display.config(state=tk.DISABLED)
 
     def load_user_groups(self):
-        try:
-            print("Loading user groups...")
-            response = self.stub.GetUserGroups(chat_pb2.GetUserGroupsRequest(
-                username=self.username_var.get()
-            ))
-            if response.success:
-                # Lưu lại group đang chọn
-                current_selection = None
-                if self.group_list.curselection():
-                    current_selection = self.group_list.get(self.group_list.curselection())
-
-                self.group_list.delete(0, tk.END)
-                self.user_groups.clear()
-                for group in response.groups:
-                    self.user_groups[group.group_id] = group.group_name
-                    self.group_list.insert(tk.END, group.group_name)
-                
-                # Khôi phục selection nếu group vẫn còn tồn tại
-                if current_selection:
-                    try:
-                        idx = list(self.user_groups.values()).index(current_selection)
-                        self.group_list.selection_set(idx)
-                        self.group_list.see(idx)
-                    except ValueError:
-                        pass
-            else:
-                print(f"Error loading groups: {response.message}")
-        except Exception as e:
-            print(f"Error loading groups: {e}")
+        # The reload runs off the Tk thread and arrives through on_groups_changed
+        log.debug("loading user groups")
+        self.core.request_group_refresh()
+
+    def show_groups(self, groups):
+        # Lưu lại group đang chọn
+        current_selection = None
+        if self.group_list.curselection():
+            current_selection = self.group_list.get(self.group_list.curselection())
+
+        self.group_list.delete(0, tk.END)
+        self.user_groups = groups
+        for group_name in groups.values():
+            self.group_list.insert(tk.END, group_name)
+
+        # Khôi phục selection nếu group vẫn còn tồn tại
+        if current_selection:
+            try:
+                idx = list(self.user_groups.values()).index(current_selection)
+                self.group_list.selection_set(idx)
+                self.group_list.see(idx)
+            except ValueError:
+                pass
+
+    def apply_group_update(self, action, group_id, group_name):
+        # Patches the one affected row instead of rebuilding the list; rows follow the order
+        # of user_groups
+        group_ids = list(self.user_groups)
+        if action == chat_pb2.GroupUpdate.REMOVED:
+            if group_id not in self.user_groups:
+                return
+            self.group_list.delete(group_ids.index(group_id))
+            del self.user_groups[group_id]
+            if group_id == self.current_group:
+                self.current_group = None
+                self.current_group_label.config(text="")
+                self.clear_display()
+        elif group_id in self.user_groups:
+            # Renamed (or added again under a new name): replace the row in place
+            idx = group_ids.index(group_id)
+            selected = idx in self.group_list.curselection()
+            self.group_list.delete(idx)
+            self.group_list.insert(idx, group_name)
+            self.user_groups[group_id] = group_name
+            if selected:
+                self.group_list.selection_set(idx)
+            if group_id == self.current_group:
+                self.current_group_label.config(text=f"Current Group: {group_name}")
+        else:
+            self.group_list.insert(tk.END, group_name)
+            self.user_groups[group_id] = group_name
 
     def on_group_select(self, event):
         selection = self.group_list.curselection()
         if selection:
             group_name = self.group_list.get(selection[0])
-            group_id = next((gid for gid, name in self.user_groups.items() if name == group_name), None)
-            if group_id:
-                self.current_group = group_id
-                self.current_group_label.config(text=f"Current Group: {group_name}")
-                self.load_group_history(group_id)
+            group_id = list(self.user_groups)[selection[0]]
+            self.current_group = group_id
+            self.current_group_label.config(text=f"Current Group: {group_name}")
+            self.load_group_history(group_id)
 
     def load_group_history(self, group_id):
         try:
-            response = self.stub.GetGroupHistory(chat_pb2.GetGroupHistoryRequest(
-                group_id=group_id
-            ))
-            if response.success:
-                self.message_display.config(state=tk.NORMAL)
-                self.message_display.delete(1.0, tk.END)
-                for message in response.messages:
-                    timestamp = datetime.fromtimestamp(message.timestamp).strftime("%H:%M:%S")
-                    self.message_display.insert(tk.END, f"[{timestamp}] {message.sender}: {message.content}\n")
-                self.message_display.config(state=tk.DISABLED)
-                self.message_display.see(tk.END)
-        except Exception as e:
-            print(f"Error loading group history: {e}")
+            # Show the locally cached history right away, then fetch only what is newer
+            # on the core's worker thread and redraw once it is in
+            self.render_cached_history(group_id)
+        except Exception:
+            log.exception("error loading group history")
+        self.core.run_later(self.sync_group_history, group_id,
+                            on_done=lambda changed: self.window.after_idle(self.history_synced, group_id, changed))
+
+    def sync_group_history(self, group_id):
+        # Runs on the core's worker thread
+        try:
+            return self.core.sync_history(group_id)
+        except Exception:
+            log.exception("error loading group history")
+            return False
+
+    def history_synced(self, group_id, changed):
+        if changed and group_id == self.current_group:
+            self.render_cached_history(group_id)
+
+    def render_cached_history(self, group_id):
+        self.clear_display()
+        rows = self.core.cached_history(group_id, HISTORY_PAGE_SIZE)
+        self.message_display.config(state=tk.NORMAL)
+        self.message_display.insert(tk.END, "".join(self.format_history(rows)))
+        self.message_display.config(state=tk.DISABLED)
+        self.rendered.extend([message_id, content.count("\n") + 1] for message_id, _, content, _ in rows)
+        self.rendered_lines = sum(lines for _, lines in self.rendered)
+        self.older_cursor = rows[0][0] if rows else 0
+        self.has_older = len(rows) == HISTORY_PAGE_SIZE
+        self.message_display.see(tk.END)
+
+    def format_history(self, rows):
+        for _, sender, content, ts in rows:
+            timestamp = datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+            yield f"[{timestamp}] {sender}: {content}\n"
+
+    def on_display_scroll(self, first, last):
+        self.message_display.vbar.set(first, last)
+        # At the top of a display that overflows: fetch the page before it
+        if float(first) <= 0.0 and float(last) < 1.0 and self.has_older and not self.loading_older:
+            self.loading_older = True
+            self.window.after_idle(self.load_older_history)
+
+    def load_older_history(self):
+        group_id = self.current_group
+        if not group_id or not self.has_older:
+            self.loading_older = False
+            return
+        # The page is fetched on the core's worker thread and drawn when it arrives
+        before_id = self.older_cursor
+        self.core.run_later(self.fetch_older_history, group_id, before_id,
+                            on_done=lambda page: self.window.after_idle(self.show_older_history, group_id, before_id, page))
+
+    def fetch_older_history(self, group_id, before_id):
+        # Runs on the core's worker thread; None if the page couldn't be loaded
+        try:
+            return self.core.older_history(group_id, before_id, HISTORY_PAGE_SIZE)
+        except Exception:
+            log.exception("error loading older history")
+            return None
+
+    def show_older_history(self, group_id, before_id, page):
+        try:
+            # Dropped if the user switched groups or the display was redrawn meanwhile
+            if page is None or group_id != self.current_group or before_id != self.older_cursor:
+                return
+            rows, self.has_older = page
+            if not rows:
+                return
+            entries = [[message_id, content.count("\n") + 1] for message_id, _, content, _ in rows]
+            added_lines = sum(lines for _, lines in entries)
+            self.message_display.config(state=tk.NORMAL)
+            self.message_display.insert("1.0", "".join(self.format_history(rows)))
+            self.message_display.config(state=tk.DISABLED)
+            self.rendered.extendleft(reversed(entries))
+            self.rendered_lines += added_lines
+            self.older_cursor = rows[0][0]
+            # Keep the line the user was looking at in place
+            self.message_display.yview(f"{added_lines + 1}.0")
+        except Exception:
+            log.exception("error loading older history")
+        finally:
+            self.loading_older = False
+
+    def resync(self):
+        # The core has already refreshed the group list
+        if self.current_group:
+            self.load_group_history(self.current_group)
 
     def create_group(self):
         group_name = simpledialog.askstring("Create Group", "Enter group name:")
@@ -427,15 +553,10 @@ class ChatClient:
             return
             
         try:
-            response = self.stub.CreateGroup(chat_pb2.CreateGroupRequest(
-                creator=self.username_var.get(),
-                group_name=group_name
-            ))
-            if response.success:
-                messagebox.showinfo("Success", f"Group '{group_name}' created successfully!")
-                self.load_user_groups()
-            else:
-                messagebox.showerror("Error", response.message)
+            self.core.create_group(group_name)
+            messagebox.showinfo("Success", f"Group '{group_name}' created successfully!")
+        except ChatError as e:
+            messagebox.showerror("Error", str(e))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to create group: {str(e)}")
 
@@ -445,15 +566,10 @@ class ChatClient:
             return
             
         try:
-            response = self.stub.JoinGroup(chat_pb2.JoinGroupRequest(
-                username=self.username_var.get(),
-                group_id=group_id
-            ))
-            if response.success:
-                messagebox.showinfo("Success", "Joined group successfully!")
-                self.load_user_groups()
-            else:
-                messagebox.showerror("Error", response.message)
+            self.core.join_group(group_id)
+            messagebox.showinfo("Success", "Joined group successfully!")
+        except ChatError as e:
+            messagebox.showerror("Error", str(e))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to join group: {str(e)}")
 
@@ -467,26 +583,18 @@ class ChatClient:
             return
             
         try:
-            response = self.stub.LeaveGroup(chat_pb2.LeaveGroupRequest(
-                username=self.username_var.get(),
-                group_id=self.current_group
-            ))
-            if response.success:
-                messagebox.showinfo("Success", "Left group successfully!")
-                # Clear current group
-                self.current_group = None
-                self.current_group_label.config(text="")
-                # Clear message display
-                self.message_display.config(state=tk.NORMAL)
-                self.message_display.delete(1.0, tk.END)
-                self.message_display.config(state=tk.DISABLED)
-                # Reload groups list
-                self.load_user_groups()
-            else:
-                messagebox.showerror("Error", response.message)
+            self.core.leave_group(self.current_group)
+            messagebox.showinfo("Success", "Left group successfully!")
+            # Clear current group
+            self.current_group = None
+            self.current_group_label.config(text="")
+            # Clear message display
+            self.clear_display()
+        except ChatError as e:
+            messagebox.showerror("Error", str(e))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to leave group: {str(e)}")
-            print(f"Error leaving group: {e}")  # Add debug logging
+            log.exception("error leaving group")
 
     def invite_user(self):
         if not self.current_group:
@@ -497,23 +605,13 @@ class ChatClient:
         if not username:
             return
             
-        if username == self.username_var.get():
-            messagebox.showerror("Error", "You cannot invite yourself")
-            return
-            
         try:
-            response = self.stub.InviteUser(chat_pb2.InviteUserRequest(
-                group_id=self.current_group,
-                inviter=self.username_var.get(),
-                invitee=username
-            ))
-            if response.success:
-                messagebox.showinfo("Success", response.message)
-            else:
-                messagebox.showerror("Error", response.message)
+            messagebox.showinfo("Success", self.core.invite_user(self.current_group, username))
+        except ChatError as e:
+            messagebox.showerror("Error", str(e))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to invite user: {str(e)}")
-            print(f"Error inviting user: {e}")  # Add debug logging
+            log.exception("error inviting user")
 
     def send_message(self):
         if not self.current_group:
@@ -523,84 +621,18 @@ class ChatClient:
         message = self.message_var.get()
         if message:
             try:
-                chat_message = chat_pb2.ChatMessage(
-                    sender=self.username_var.get(),
-                    content=message,
-                    type=chat_pb2.GROUP,
-                    group_id=self.current_group
-                )
-                
-                # Check if we are a member of the group
-                if self.current_group not in self.user_groups:
-                    messagebox.showerror("Error", "You are not a member of this group")
-                    return
-                    
-                self.message_queue.put(chat_message)
+                chat_message = self.core.send(self.current_group, message)
                 self.display_sent_message(chat_message)
                 self.message_var.set("")  # Clear input field
+            except ChatError as e:
+                messagebox.showerror("Error", str(e))
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to send message: {str(e)}")
 
-    def display_message(self, message):
-        try:
-            self.message_display.config(state=tk.NORMAL)
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            
-            # Xử lý tin nhắn hệ thống
-            if message.sender == "System":
-                # Kiểm tra nếu là tin nhắn cập nhật danh sách group
-                if message.content == "UPDATE_GROUPS":
-                    self.window.after(100, self.load_user_groups)
-                    return
-                
-                # Hiển thị tin nhắn hệ thống thông thường
-                self.message_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
-                self.message_display.insert(tk.END, f"System: ", "system")
-                self.message_display.insert(tk.END, f"{message.content}\n", "system_content")
-                self.message_display.tag_configure("timestamp", foreground="#666666")
-                self.message_display.tag_configure("system", foreground="#FF0000", font=("Helvetica", 10, "bold"))
-                self.message_display.tag_configure("system_content", foreground="#FF0000")
-                self.message_display.see(tk.END)
-                self.message_display.update_idletasks()
-                
-                # Nếu tin nhắn chứa thông tin về group mới, cập nhật danh sách
-                if "invited to group" in message.content or "joined the group" in message.content:
-                    self.window.after(100, self.load_user_groups)
-            
-            # Hiển thị tin nhắn nhóm
-            elif message.type == chat_pb2.GROUP and str(message.group_id) == str(self.current_group):
-                self.message_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
-                self.message_display.insert(tk.END, f"{message.sender}: ", "sender")
-                self.message_display.insert(tk.END, f"{message.content}\n", "content")
-                self.message_display.tag_configure("timestamp", foreground="#666666")
-                self.message_display.tag_configure("sender", foreground="#0000FF", font=("Helvetica", 10, "bold"))
-                self.message_display.tag_configure("content", foreground="#000000")
-                self.message_display.see(tk.END)
-                self.message_display.update_idletasks()
-            
-            self.message_display.config(state=tk.DISABLED)
-        except Exception as e:
-            print(f"Error displaying message: {e}")
-
     def display_sent_message(self, message):
-        try:
-            self.message_display.config(state=tk.NORMAL)
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            
-            self.message_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
-            self.message_display.insert(tk.END, f"You: ", "sender")
-            self.message_display.insert(tk.END, f"{message.content}\n", "content")
-            
-            self.message_display.tag_configure("timestamp", foreground="#666666")
-            self.message_display.tag_configure("sender", foreground="#008000", font=("Helvetica", 10, "bold"))
-            self.message_display.tag_configure("content", foreground="#000000")
-            
-            self.message_display.see(tk.END)
-            self.message_display.update_idletasks()
-            
-            self.message_display.config(state=tk.DISABLED)
-        except Exception as e:
-            print(f"Error displaying sent message: {e}")
+        # Drawn right away, after anything still waiting for the next frame
+        self.pending.append((message, True))
+        self.flush_pending()
 
     def show_register_dialog(self):
         # Create a new top-level window for registration
@@ -666,16 +698,11 @@ class ChatClient:
                 return
             
             try:
-                response = self.stub.Register(chat_pb2.RegisterRequest(
-                    username=username,
-                    password=password
-                ))
-                
-                if response.success:
-                    messagebox.showinfo("Success", "Registration successful! Please login.")
-                    register_window.destroy()
-                else:
-                    status_label.config(text=response.message, foreground="red")
+                self.core.register(username, password)
+                messagebox.showinfo("Success", "Registration successful! Please login.")
+                register_window.destroy()
+            except ChatError as e:
+                status_label.config(text=str(e), foreground="red")
             except Exception as e:
                 status_label.config(text=f"Registration failed: {str(e)}", foreground="red")
         
@@ -691,27 +718,16 @@ class ChatClient:
 
     def sign_out(self):
         try:
-            # Stop the message receiver thread
-            self.is_running = False
-            if self.receiver_thread:
-                self.receiver_thread.join(timeout=1.0)
-            
+            # Closes the Chat stream and the local cache, and forgets the session
+            self.core.logout()
+
             # Clear all data
             self.current_group = None
-            self.user_groups.clear()
+            self.user_groups = {}
             self.group_list.delete(0, tk.END)
-            self.message_display.config(state=tk.NORMAL)
-            self.message_display.delete(1.0, tk.END)
-            self.message_display.config(state=tk.DISABLED)
+            self.clear_display()
             self.current_group_label.config(text="")
             
-            # Clear message queue
-            while not self.message_queue.empty():
-                try:
-                    self.message_queue.get_nowait()
-                except queue.Empty:
-                    break
-            
             # Show login frame and hide chat frame
             self.chat_frame.grid_remove()
             self.login_frame.grid()
@@ -722,24 +738,25 @@ class ChatClient:
             
             messagebox.showinfo("Success", "Signed out successfully!")
         except Exception as e:
-            print(f"Error during sign out: {e}")
+            log.exception("error during sign out")
             messagebox.showerror("Error", f"Error during sign out: {str(e)}")
 
-    def reconnect(self):
-        try:
-            if not self.is_running:
-                print("Attempting to reconnect...")
-                self.start_chat(self.username_var.get())
-        except Exception as e:
-            print(f"Error reconnecting: {e}")
-            self.window.after(1000, self.reconnect)  # Try again after 1 second
-
     def run(self):
         self.window.mainloop()
 
 def main():
-    client = ChatClient()
-    client.run()
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--scrollback", type=int, default=SCROLLBACK_LINES,
+                        help=f"lines kept in the message view; older ones reload on scroll-up (default: {SCROLLBACK_LINES})")
+    args = parser.parse_args()
+
+    # Level and sampling come from CHAT_LOG_LEVEL / CHAT_LOG_SAMPLE
+    setup_logging()
+    try:
+        client = ChatClient(scrollback=args.scrollback)
+        client.run()
+    finally:
+        shutdown_logging()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import re
+import sqlite3
+import threading
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".grpc_chat")
+
+
+class MessageCache:
+    # Local SQLite copy of group history, one database file per user. Only messages that
+    # came from GetGroupHistory are stored, since those carry server message ids; each
+    # group's cached range is kept contiguous so its last id is a safe sync cursor. The UI
+    # thread and the core's worker thread share it, one call at a time.
+    def __init__(self, username, cache_dir=CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", username)
+        self.path = os.path.join(cache_dir, f"{safe_name}.sqlite3")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                group_id TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                sender TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                PRIMARY KEY (group_id, id)
+            )
+        """)
+        self.conn.commit()
+
+    def last_id(self, group_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MAX(id) FROM messages WHERE group_id = ?", (group_id,)
+            ).fetchone()
+            return row[0] or 0
+
+    def recent(self, group_id, limit):
+        # Newest `limit` messages, returned oldest first as (id, sender, content, timestamp)
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT id, sender, content, timestamp FROM messages
+                WHERE group_id = ? ORDER BY id DESC LIMIT ?
+            """, (group_id, limit)).fetchall()
+            rows.reverse()
+            return rows
+
+    def before(self, group_id, before_id, limit):
+        # Up to `limit` messages older than before_id, oldest first
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT id, sender, content, timestamp FROM messages
+                WHERE group_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+            """, (group_id, before_id, limit)).fetchall()
+            rows.reverse()
+            return rows
+
+    def add(self, group_id, messages):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO messages (group_id, id, sender, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [(group_id, m.id, m.sender, m.content, m.timestamp) for m in messages]
+            )
+            self.conn.commit()
+
+    def clear_group(self, group_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE group_id = ?", (group_id,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,309 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+
+from metrics import DB_POOL_WAIT
+
+DB_CONFIG = {
+    'host': "localhost",
+    'user': "root",
+    'password': "root",
+    'database': "chat_db",
+    'connect_timeout': 60,
+    'connection_timeout': 60,
+}
+
+# Read queries on the hot paths. migrate.py --check-plans runs EXPLAIN on these to make
+# sure they stay on their indexes (see migrations/002_message_ids_and_indexes.sql).
+GROUP_HISTORY_PAGE_QUERY = """
+    SELECT m.id, m.content, m.timestamp, u.username as sender
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.group_id = %s AND m.id < %s
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+GROUP_HISTORY_AFTER_QUERY = """
+    SELECT m.id, m.content, m.timestamp, u.username as sender
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.group_id = %s AND m.id > %s
+    ORDER BY m.id ASC
+    LIMIT %s
+"""
+
+# Messages of a group after a client's last-seen sequence number, replayed when it resumes
+GROUP_REPLAY_QUERY = """
+    SELECT m.id, m.content, m.timestamp, m.seq, u.username as sender
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.group_id = %s AND m.seq > %s AND u.username != %s
+    ORDER BY m.seq ASC
+    LIMIT %s
+"""
+
+# Client message ids among the last n messages (a primary key range), oldest first
+RECENT_CLIENT_IDS_QUERY = """
+    SELECT u.username as sender, m.client_msg_id, m.timestamp
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.id > (SELECT COALESCE(MAX(id), 0) FROM messages) - %s AND m.client_msg_id IS NOT NULL
+    ORDER BY m.id ASC
+"""
+
+USER_GROUPS_QUERY = """
+    SELECT g.id as group_id, g.group_name, g.last_seq
+    FROM `groups` g
+    JOIN group_members gm ON g.id = gm.group_id
+    WHERE gm.user_id = %s
+"""
+
+# `groups` is a reserved word from MySQL 8.0.2 on, so every statement quotes it
+CREATE_GROUP_QUERY = "INSERT INTO `groups` (group_name, creator_id) VALUES (%s, %s)"
+
+GROUP_LAST_SEQ_QUERY = "SELECT last_seq FROM `groups` WHERE id = %s"
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolStats:
+    # Tracks how long callers wait to check out a connection
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.reconnects = 0
+
+    def record_wait(self, seconds):
+        DB_POOL_WAIT.observe(seconds)
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            if seconds > self.wait_max:
+                self.wait_max = seconds
+
+    def record(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_avg_ms': (self.wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                'wait_max_ms': self.wait_max * 1000,
+                'timeouts': self.timeouts,
+                'health_checks': self.health_checks,
+                'reconnects': self.reconnects,
+            }
+
+
+class ConnectionPool:
+    # Thread-safe pool of MySQL connections. Each caller checks out its own connection,
+    # so concurrent RPCs never share a cursor or a socket. Connections are opened lazily
+    # and only pinged when they have been idle longer than idle_check_interval.
+    def __init__(self, size=10, idle_check_interval=30, checkout_timeout=30, **connect_args):
+        self.size = size
+        self.idle_check_interval = idle_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.connect_args = connect_args
+        self.stats = PoolStats()
+        # LIFO keeps the most recently used (warm) connections in rotation
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put((None, 0.0))
+
+    def new_connection(self):
+        return mysql.connector.connect(autocommit=True, **self.connect_args)
+
+    def acquire(self):
+        start = time.monotonic()
+        try:
+            conn, last_used = self.idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            self.stats.record('timeouts')
+            raise PoolTimeout(f"No database connection available after {self.checkout_timeout}s")
+        self.stats.record_wait(time.monotonic() - start)
+
+        try:
+            if conn is None:
+                conn = self.new_connection()
+            elif time.monotonic() - last_used > self.idle_check_interval:
+                self.stats.record('health_checks')
+                try:
+                    conn.ping(reconnect=False)
+                except mysql.connector.Error:
+                    self.stats.record('reconnects')
+                    self.discard(conn)
+                    conn = self.new_connection()
+        except Exception:
+            # Give the slot back so a failed connect doesn't shrink the pool
+            self.idle.put((None, 0.0))
+            raise
+        return conn
+
+    def release(self, conn):
+        self.idle.put((conn, time.monotonic()))
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def replace(self, conn):
+        # Close a connection that can't be reused and free its slot for a fresh one
+        self.discard(conn)
+        self.idle.put((None, 0.0))
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+            # The connection is likely dead; replace it with an empty slot
+            self.replace(conn)
+            raise
+        except Exception:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                self.discard(conn)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_name TEXT NOT NULL,
+    creator_id INTEGER NOT NULL REFERENCES users(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_id INTEGER NOT NULL REFERENCES groups(id),
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (group_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender_id INTEGER NOT NULL REFERENCES users(id),
+    content TEXT NOT NULL,
+    message_type INTEGER NOT NULL,
+    group_id INTEGER REFERENCES groups(id),
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    seq INTEGER NOT NULL DEFAULT 0,
+    client_msg_id TEXT,
+    UNIQUE (sender_id, client_msg_id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_group_id ON messages (group_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_group_seq ON messages (group_id, seq);
+"""
+
+
+class SQLiteCursor:
+    # Translates the MySQL-flavoured SQL the servicer issues into SQLite and returns dict rows
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=()):
+        query = query.replace("%s", "?").replace("NOW()", "CURRENT_TIMESTAMP").replace("GREATEST(", "MAX(")
+        query = query.replace("INSERT IGNORE", "INSERT OR IGNORE")
+        params = [p.decode() if isinstance(p, bytes) else p for p in params]
+        self.cursor.execute(query, params)
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return dict(row) if row is not None else None
+
+    def fetchall(self):
+        return [dict(row) for row in self.cursor.fetchall()]
+
+    def fetchmany(self, size):
+        return [dict(row) for row in self.cursor.fetchmany(size)]
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    # The subset of the mysql.connector connection API used by ChatServicer
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, dictionary=False, buffered=False):
+        return SQLiteCursor(self.conn.cursor())
+
+    def start_transaction(self):
+        # Takes the write lock up front, so two transactions never deadlock upgrading to it
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLitePool(ConnectionPool):
+    # ConnectionPool backed by SQLite, for SQLiteStorage. A database file is opened in WAL
+    # mode, where readers don't wait for the writer, so it gets several connections; writers
+    # still take turns on SQLite's file lock, also across server processes sharing the file.
+    # ":memory:" is private to its connection and therefore has exactly one.
+    def __init__(self, path, size=4):
+        self.path = path
+        super().__init__(size=1 if path == ":memory:" else size, idle_check_interval=float("inf"))
+
+    def new_connection(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30,
+                               detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode this only gives up durability of the last commits on power loss
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        return SQLiteConnection(conn)
+
+    def replace(self, conn):
+        # Closing the connection would drop an in-memory database, and SQLite cursors
+        # leave nothing unread on the connection, so it can simply go back into the pool
+        self.release(conn)
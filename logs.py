@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured, leveled logging shared by the server and the client. Log calls take an
+# event message plus key=value fields:
+#
+#     log = get_logger(__name__)
+#     log.info("user connected", user=username)
+#     log.sampled("message received", user=username)   # per-message event, 1 in N
+#
+# Records go through a bounded in-memory queue to a listener thread, which does all of
+# the formatting and I/O. A call below the configured level costs one level check, so
+# with the default INFO level the message path does no formatting at all.
+
+DEFAULT_SAMPLE_EVERY = 100
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_output=False):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.json_output:
+            entry = {
+                "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                "level": record.levelname,
+                "logger": record.name,
+                "event": record.getMessage(),
+            }
+            entry.update(fields)
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Hands records to the listener thread untouched (QueueHandler would format them in the
+    # caller's thread) and drops them when the queue is full rather than blocking the caller
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Logger:
+    # Thin wrapper over logging.Logger that takes structured fields as keyword arguments
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.counts = {}  # sampled event -> occurrences so far
+
+    def log(self, level, event, exc_info=None, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+    def sampled(self, event, level=logging.DEBUG, **fields):
+        # For per-message events: logs the first and then every Nth occurrence of an event
+        if not self.logger.isEnabledFor(level):
+            return
+        every = settings["sample_every"]
+        with self.lock:
+            count = self.counts.get(event, 0) + 1
+            self.counts[event] = count
+        if every <= 1 or count % every == 1:
+            self.log(level, event, occurrence=count, **fields)
+
+
+settings = {"sample_every": DEFAULT_SAMPLE_EVERY}
+state = {"listener": None, "handler": None}
+
+
+def get_logger(name):
+    return Logger(logging.getLogger(name))
+
+
+def setup_logging(level=None, json_output=False, sample_every=None, stream=None, max_queue=10000):
+    # level defaults to CHAT_LOG_LEVEL or INFO; sample_every to CHAT_LOG_SAMPLE or 100
+    level = level or os.environ.get("CHAT_LOG_LEVEL", "INFO")
+    settings["sample_every"] = int(sample_every or os.environ.get("CHAT_LOG_SAMPLE", DEFAULT_SAMPLE_EVERY))
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(json_output))
+    log_queue = queue.Queue(maxsize=max_queue)
+    handler = DroppingQueueHandler(log_queue)
+    listener = QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    state["listener"], state["handler"] = listener, handler
+
+
+def shutdown_logging():
+    # Flushes whatever is still queued; safe to call more than once
+    listener, handler = state["listener"], state["handler"]
+    if listener is not None:
+        listener.stop()
+        logging.getLogger().removeHandler(handler)
+        if handler.dropped:
+            sys.stderr.write(f"{handler.dropped} log records were dropped because the log queue was full\n")
+    state["listener"] = state["handler"] = None
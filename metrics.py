@@ -0,0 +1,326 @@
+import asyncio
+import bisect
+import inspect
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+
+from logs import get_logger
+
+log = get_logger("metrics")
+
+# Minimal Prometheus-style metrics: counters, gauges and histograms with labels, plus
+# callback metrics read at scrape time, rendered in the text exposition format. Kept
+# dependency-free on purpose; the hot path only takes a lock and bumps a few numbers.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> value
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                                for key, value in items]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), then sum and count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, key, [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    # Read at scrape time from state the server already keeps. func returns a number or a
+    # list of (label values dict, number) pairs.
+    def __init__(self, name, help, type, func, labels=()):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.func = func
+
+    def render(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {e}"]
+        if not isinstance(result, list):
+            result = [({}, result)]
+        return self.header() + [f"{self.name}{format_labels(self.labels, self.key(labels))} {format_value(value)}"
+                                for labels, value in result]
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            # Re-registering a callback (e.g. a new servicer in the same process) replaces it
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def callback(name, help, type, func, labels=()):
+    return REGISTRY.register(CallbackMetric(name, help, type, func, labels))
+
+
+RPC_DURATION = histogram("chat_rpc_duration_seconds", "RPC handling time; for streams, the stream's lifetime",
+                         ("method", "code"))
+RPC_IN_FLIGHT = gauge("chat_rpc_in_flight", "RPCs currently being handled", ("method",))
+DB_QUERY_DURATION = histogram("chat_db_query_duration_seconds", "Database statement latency", ("statement",))
+DB_RETRIES = counter("chat_db_retries_total", "Statements retried after a database error", ("statement",))
+DB_ERRORS = counter("chat_db_errors_total", "Statements that failed on every attempt", ("statement",))
+DB_POOL_WAIT = histogram("chat_db_pool_wait_seconds", "Time spent waiting to check out a pooled connection")
+FANOUT_RECIPIENTS = histogram("chat_fanout_recipients", "Online recipients per group message", buckets=SIZE_BUCKETS)
+MESSAGES = counter("chat_messages_total", "Chat messages accepted for fan-out")
+DUPLICATE_MESSAGES = counter("chat_duplicate_messages_total", "Resent chat messages dropped by client message id")
+
+
+@lru_cache(maxsize=256)
+def statement_label(query):
+    # "SELECT messages", "INSERT group_members", ... so labels stay few however the SQL is formatted
+    verb = query.split(None, 1)[0].upper() if query.strip() else "?"
+    match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+`?(\w+)", query, re.IGNORECASE)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def status_name(context, default="OK"):
+    # Sync and aio contexts both expose the code set by set_code/abort
+    try:
+        code = context.code()
+    except Exception:
+        code = None
+    if code is None:
+        return default
+    return code.name if isinstance(code, grpc.StatusCode) else str(code)
+
+
+def instrument(behavior, method):
+    # Wraps one RPC handler function while keeping its kind (sync/async, unary/streaming),
+    # which is how grpc.aio decides whether to run it on the loop or the thread pool
+    def finish(start, context, code):
+        RPC_IN_FLIGHT.dec(method=method)
+        RPC_DURATION.observe(time.perf_counter() - start, method=method, code=status_name(context, code))
+
+    if inspect.isasyncgenfunction(behavior):
+        async def wrapper(request, context):
+            start, code = time.perf_counter(), "OK"
+            RPC_IN_FLIGHT.inc(method=method)
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except (asyncio.CancelledError, GeneratorExit):
+                code = "CANCELLED"
+                raise
+            except BaseException:
+                code = "UNKNOWN"
+                raise
+            finally:
+                finish(start, context, code)
+    elif inspect.iscoroutinefunction(behavior):
+        async def wrapper(request, context):
+            start, code = time.perf_counter(), "OK"
+            RPC_IN_FLIGHT.inc(method=method)
+            try:
+                return await behavior(request, context)
+            except asyncio.CancelledError:
+                code = "CANCELLED"
+                raise
+            except BaseException:
+                code = "UNKNOWN"
+                raise
+            finally:
+                finish(start, context, code)
+    elif inspect.isgeneratorfunction(behavior):
+        def wrapper(request, context):
+            start, code = time.perf_counter(), "OK"
+            RPC_IN_FLIGHT.inc(method=method)
+            try:
+                yield from behavior(request, context)
+            except GeneratorExit:
+                code = "CANCELLED"
+                raise
+            except BaseException:
+                code = "UNKNOWN"
+                raise
+            finally:
+                finish(start, context, code)
+    else:
+        def wrapper(request, context):
+            start, code = time.perf_counter(), "OK"
+            RPC_IN_FLIGHT.inc(method=method)
+            try:
+                return behavior(request, context)
+            except BaseException:
+                code = "UNKNOWN"
+                raise
+            finally:
+                finish(start, context, code)
+    return wrapper
+
+
+HANDLER_FACTORIES = {
+    (False, False): ("unary_unary", grpc.unary_unary_rpc_method_handler),
+    (False, True): ("unary_stream", grpc.unary_stream_rpc_method_handler),
+    (True, False): ("stream_unary", grpc.stream_unary_rpc_method_handler),
+    (True, True): ("stream_stream", grpc.stream_stream_rpc_method_handler),
+}
+
+
+def instrument_handler(handler, full_method):
+    if handler is None:
+        return None
+    method = full_method.rsplit("/", 1)[-1]
+    attribute, factory = HANDLER_FACTORIES[(handler.request_streaming, handler.response_streaming)]
+    return factory(
+        instrument(getattr(handler, attribute), method),
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer
+    )
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    def intercept_service(self, continuation, handler_call_details):
+        return instrument_handler(continuation(handler_call_details), handler_call_details.method)
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    async def intercept_service(self, continuation, handler_call_details):
+        return instrument_handler(await continuation(handler_call_details), handler_call_details.method)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    # Serves GET /metrics from a daemon thread; local-only unless host says otherwise
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info("metrics endpoint started", url=f"http://{host}:{port}/metrics")
+    return server
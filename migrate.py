@@ -0,0 +1,114 @@
+import argparse
+import glob
+import os
+import re
+import sys
+
+import mysql.connector
+
+from db import (CREATE_GROUP_QUERY, DB_CONFIG, GROUP_HISTORY_AFTER_QUERY, GROUP_HISTORY_PAGE_QUERY, GROUP_LAST_SEQ_QUERY,
+                GROUP_REPLAY_QUERY, USER_GROUPS_QUERY)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Version 1 is the original schema.sql; numbered files in migrations/ build on top of it
+BASELINE_VERSION = 1
+
+# (RPC, query, sample params, table alias, index the alias must be read through). With no
+# index, the statement only has to be accepted, e.g. one on the reserved-word `groups` table.
+PLAN_CHECKS = [
+    ("GetGroupHistory", GROUP_HISTORY_PAGE_QUERY, (1, 2 ** 63 - 1, 51), "m", "idx_messages_group_id"),
+    ("GetGroupHistory (after_id)", GROUP_HISTORY_AFTER_QUERY, (1, 0, 51), "m", "idx_messages_group_id"),
+    ("GetUserGroups", USER_GROUPS_QUERY, (1,), "gm", "idx_group_members_user"),
+    ("Chat resume", GROUP_REPLAY_QUERY, (1, 0, "", 201), "m", "idx_messages_group_seq"),
+    ("CreateGroup", CREATE_GROUP_QUERY, ("plan check", 1), "groups", None),
+    ("Group seq seed", GROUP_LAST_SEQ_QUERY, (1,), "groups", None),
+]
+
+
+def connect():
+    return mysql.connector.connect(autocommit=True, **DB_CONFIG)
+
+
+def available_migrations():
+    migrations = []
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql"))):
+        match = re.match(r"(\d+)_", os.path.basename(path))
+        if match:
+            migrations.append((int(match.group(1)), path))
+    return migrations
+
+
+def split_statements(sql):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+def applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    versions = {row[0] for row in cursor.fetchall()}
+    if not versions:
+        # Databases created from the original schema.sql have no version table yet
+        cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (BASELINE_VERSION,))
+        versions.add(BASELINE_VERSION)
+    return versions
+
+
+def migrate(conn):
+    cursor = conn.cursor()
+    done = applied_versions(cursor)
+    pending = [(version, path) for version, path in available_migrations() if version not in done]
+    if not pending:
+        print("Schema is up to date")
+    for version, path in pending:
+        print(f"Applying migration {os.path.basename(path)}")
+        with open(path) as f:
+            for statement in split_statements(f.read()):
+                cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+    cursor.close()
+
+
+def check_plans(conn):
+    # Fails when a hot read query stops using its index or falls back to a filesort
+    cursor = conn.cursor(dictionary=True)
+    failures = []
+    for rpc, query, params, alias, index in PLAN_CHECKS:
+        cursor.execute("EXPLAIN " + query, params)
+        plan = cursor.fetchall()
+        row = next((r for r in plan if r['table'] == alias), None)
+        if index is not None and (row is None or row['key'] != index or row['type'] == "ALL"):
+            failures.append(f"{rpc}: expected '{alias}' to use {index}, got {row}")
+        for r in plan:
+            if "Using filesort" in (r['Extra'] or ""):
+                failures.append(f"{rpc}: filesort on '{r['table']}'")
+        print(f"{rpc}: " + "; ".join(f"{r['table']} via {r['key']} ({r['type']})" for r in plan))
+    cursor.close()
+    for failure in failures:
+        print(f"Plan check failed - {failure}")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the chat database")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="after migrating, EXPLAIN the history, replay and group-list queries and exit non-zero if they don't use their indexes")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        migrate(conn)
+        if args.check_plans and not check_plans(conn):
+            sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+-- Message ids become the ordering key for group history (keyset pagination on id),
+-- so they move to BIGINT before INT AUTO_INCREMENT can run out.
+ALTER TABLE messages MODIFY id BIGINT NOT NULL AUTO_INCREMENT;
+
+-- GetGroupHistory: WHERE group_id = ? AND id < ? ORDER BY id DESC LIMIT n
+-- reads a range of this index backwards instead of file-sorting the whole group.
+ALTER TABLE messages ADD INDEX idx_messages_group_id (group_id, id);
+
+-- GetUserGroups: WHERE user_id = ? joined on group_id is answered from this index alone.
+ALTER TABLE group_members ADD INDEX idx_group_members_user (user_id, group_id);
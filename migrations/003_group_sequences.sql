@@ -0,0 +1,8 @@
+-- Group messages carry a per-group sequence number so reconnecting clients can ask for
+-- exactly what they missed. groups.last_seq is the counter; messages sent before this
+-- migration keep seq 0 and are never replayed.
+ALTER TABLE `groups` ADD COLUMN last_seq BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE messages ADD COLUMN seq BIGINT NOT NULL DEFAULT 0;
+
+-- Chat resume: WHERE group_id = ? AND seq > ? ORDER BY seq LIMIT n
+ALTER TABLE messages ADD INDEX idx_messages_group_seq (group_id, seq);
@@ -0,0 +1,6 @@
+-- Clients give every message an id of their own and resend recent messages after a
+-- reconnect, and failed INSERTs are retried. The unique key lets the batched
+-- INSERT IGNORE skip rows that are already stored. Messages without an id (older
+-- clients, rows from before this migration) are NULL and never collide.
+ALTER TABLE messages ADD COLUMN client_msg_id VARCHAR(64) NULL;
+ALTER TABLE messages ADD UNIQUE KEY uq_messages_client_msg_id (sender_id, client_msg_id);
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# What to do when a connection's outbound buffer is full
+DROP_OLDEST = "drop_oldest"  # discard the oldest queued message to make room
+DISCONNECT = "disconnect"    # close the stream; the client reconnects and reloads history
+RESYNC = "resync"            # discard the backlog and queue a RESYNC marker telling the client to reload history
+POLICIES = (DROP_OLDEST, DISCONNECT, RESYNC)
+
+RESYNC_CONTENT = "RESYNC"
+
+
+class EncodedMessage:
+    # A ChatMessage serialized once for every stream it is queued on. Queues treat it like the
+    # message itself; the Chat handler's serializer (serialize_chat_message) writes its bytes
+    # as they are, so fanning out to N members costs one encoding instead of N.
+    __slots__ = ("message", "data")
+
+    def __init__(self, message, data=None):
+        self.message = message
+        self.data = message.SerializeToString() if data is None else data
+
+    @property
+    def group_id(self):
+        return self.message.group_id
+
+    @property
+    def seq(self):
+        return self.message.seq
+
+
+def serialize_chat_message(item):
+    if isinstance(item, EncodedMessage):
+        return item.data
+    return item.SerializeToString()
+
+
+class OutboundStats:
+    # Server-wide counters shared by every outbound queue
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.disconnects = 0
+        self.resyncs = 0
+        self.idle_closes = 0
+        self.replayed = 0
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'disconnects': self.disconnects,
+                'resyncs': self.resyncs,
+                'idle_closes': self.idle_closes,
+                'replayed': self.replayed,
+            }
+
+
+class OutboundQueue:
+    # Bounded buffer between fan-out and one client's Chat stream. put() never blocks the
+    # sender: when the buffer is full the slow-consumer policy decides what gives way.
+    # get() blocks until a message is available and returns None once the queue is closed.
+    def __init__(self, maxsize=1000, policy=DROP_OLDEST, stats=None, resync_message=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats = stats or OutboundStats()
+        self.resync_message = resync_message
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+        self.overflowed = False  # closed by the DISCONNECT policy
+        self.dropped = 0
+        self.last_active = time.monotonic()  # last time the client sent anything on this stream
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, message):
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                    self.stats.add('dropped')
+                elif self.policy == DISCONNECT:
+                    self.dropped += len(self.items) + 1
+                    self.stats.add('dropped', len(self.items) + 1)
+                    self.stats.add('disconnects')
+                    self.items.clear()
+                    self.closed = True
+                    self.overflowed = True
+                    self.notify()
+                    return False
+                else:
+                    self.dropped += len(self.items)
+                    self.stats.add('dropped', len(self.items))
+                    self.stats.add('resyncs')
+                    self.items.clear()
+                    self.items.append(self.resync_message)
+            self.items.append(message)
+            self.stats.add('enqueued')
+            self.notify()
+            return True
+
+    def prepend(self, messages):
+        # Queues replayed messages ahead of everything already queued. Group messages that
+        # are already queued (same group and seq) are skipped. Returns how many were added.
+        with self.lock:
+            if self.closed:
+                return 0
+            queued = {(item.group_id, item.seq) for item in self.items if item.seq}
+            fresh = [message for message in messages if (message.group_id, message.seq) not in queued]
+            self.items.extendleft(reversed(fresh))
+            self.stats.add('replayed', len(fresh))
+            if fresh:
+                self.notify()
+            return len(fresh)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.notify()
+
+    def notify(self):
+        # Called with the lock held
+        self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.items:
+                return self.items.popleft()
+            return None
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    # Same buffer and policies, but the consumer is a coroutine. put() may be called from
+    # any thread; the waiting coroutine is woken through the event loop.
+    def __init__(self, loop, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def get_async(self):
+        while True:
+            with self.lock:
+                if self.items:
+                    return self.items.popleft()
+                if self.closed:
+                    return None
+                self.ready.clear()
+            await self.ready.wait()
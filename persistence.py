@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+
+from logs import get_logger
+
+log = get_logger("persistence")
+
+_STOP = object()
+
+
+class MessageWriter:
+    # Write-behind persistence for chat messages. Callers submit rows and return
+    # immediately; a background thread groups them into multi-row INSERTs, flushing when
+    # a batch is full or flush_interval has passed since its first row. submit() blocks
+    # once max_pending rows are buffered, which pushes back on the senders instead of
+    # growing memory without bound.
+    def __init__(self, write_rows, batch_size=200, flush_interval=0.05, max_pending=10000):
+        self.write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, name="message-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, row):
+        if self.closed:
+            raise RuntimeError("Message writer is closed")
+        self.pending.put(row)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.pending.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            self.write_rows(batch)
+            with self.lock:
+                self.written += len(batch)
+                self.batches += 1
+        except Exception:
+            with self.lock:
+                self.failed += len(batch)
+            log.exception("error persisting messages", count=len(batch))
+
+    def close(self, timeout=None):
+        # Everything submitted before close() is flushed before the writer thread exits
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(_STOP)
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': self.pending.qsize(),
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+RECENT_MESSAGES_PER_GROUP = 256  # messages kept in memory per group for replay on reconnect
+LOCK_STRIPES = 64
+DEDUP_WINDOW = 300  # seconds a client message id is remembered; longer than clients resend for
+DEDUP_MAX_IDS = 100000
+
+
+class GroupLog:
+    # Numbers each group's messages and keeps the most recent ones, so a client that
+    # reconnects gets exactly the messages it missed.
+    #
+    # Counters start from load_last_seq (the stored value) the first time a group is seen.
+    # With several nodes, each group is only ever numbered by its owner node (see
+    # SocketBackplane.group_owner); the others record() what it broadcasts, so every node
+    # can replay any group from memory.
+    #
+    # Callers hold lock(group_id) while they number or record a message *and* fan it out,
+    # so every queue receives a group's messages in seq order, and a resuming stream can
+    # take its snapshot between two deliveries.
+    def __init__(self, load_last_seq, size=RECENT_MESSAGES_PER_GROUP):
+        self.load_last_seq = load_last_seq
+        self.size = size
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.last_seqs = {}  # group id -> last seq handed out or seen
+        self.recent = {}  # group id -> deque of the last `size` messages
+
+    def lock(self, group_id):
+        return self.locks[group_id % LOCK_STRIPES]
+
+    def last_seq(self, group_id):
+        # The last seq handed out or seen here, or None for a group not seen since startup
+        return self.last_seqs.get(group_id)
+
+    def start(self, group_id, last_seq):
+        # Called with lock(group_id) held: tracks a group not seen since startup from last_seq
+        if group_id not in self.last_seqs:
+            self.last_seqs[group_id] = last_seq
+            self.recent[group_id] = deque(maxlen=self.size)
+
+    def append(self, group_id, message):
+        # Called with lock(group_id) held; sets message.seq
+        last_seq = self.last_seqs.get(group_id)
+        if last_seq is None:
+            last_seq = self.load_last_seq(group_id)
+            self.recent[group_id] = deque(maxlen=self.size)
+        message.seq = last_seq + 1
+        self.last_seqs[group_id] = message.seq
+        self.recent[group_id].append(message)
+        return message.seq
+
+    def record(self, group_id, message):
+        # Called with lock(group_id) held, for a message another node numbered
+        last_seq = self.last_seqs.get(group_id)
+        if last_seq is not None and message.seq <= last_seq:
+            return
+        if last_seq is None or message.seq != last_seq + 1:
+            # First message seen from this group, or some never arrived: buffer from here on
+            self.recent[group_id] = deque(maxlen=self.size)
+        self.last_seqs[group_id] = message.seq
+        self.recent[group_id].append(message)
+
+    def since(self, group_id, seq, partial=False):
+        # Called with lock(group_id) held. The buffered messages after seq, or None when
+        # the buffer doesn't reach back that far; with partial, whatever part of them is
+        # buffered
+        recent = self.recent.get(group_id)
+        if recent is None:
+            return [] if partial else None
+        if seq >= self.last_seqs[group_id]:
+            return []
+        if not partial and (not recent or recent[0].seq > seq + 1):
+            return None
+        return [message for message in recent if message.seq > seq]
+
+
+class RecentIds:
+    # Client message ids seen in the last `window` seconds, at most max_ids of them, oldest
+    # forgotten first. Clients resend their recent messages after a reconnect because they
+    # can't tell which ones arrived; the id lets the server take each one only once.
+    #
+    # With several nodes the check is made by the group's owner node, which every message
+    # of the group passes through wherever it was sent; the other nodes add the ids they
+    # see fanned out, so they can drop a resend before passing it on.
+    def __init__(self, window=DEDUP_WINDOW, max_ids=DEDUP_MAX_IDS):
+        self.window = window
+        self.max_ids = max_ids
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()  # id -> when it was first seen, oldest first
+
+    def add(self, key):
+        # False when key was already seen within the window
+        now = time.monotonic()
+        with self.lock:
+            while self.ids:
+                oldest, seen_at = next(iter(self.ids.items()))
+                if now - seen_at < self.window and len(self.ids) < self.max_ids:
+                    break
+                del self.ids[oldest]
+            if key in self.ids:
+                return False
+            self.ids[key] = now
+            return True
+
+    def seen(self, key):
+        # Whether key was added within the window, without adding it
+        with self.lock:
+            seen_at = self.ids.get(key)
+            return seen_at is not None and time.monotonic() - seen_at < self.window
+
+    def load(self, entries):
+        # (key, datetime first seen) pairs, oldest first, e.g. from stored messages, so ids
+        # taken before a restart are still recognised when clients resend them
+        now, wall_now = time.monotonic(), datetime.now()
+        with self.lock:
+            for key, seen_at in entries:
+                age = (wall_now - seen_at).total_seconds()
+                if age < self.window:
+                    self.ids[key] = now - age
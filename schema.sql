@@ -8,11 +8,12 @@ CREATE TABLE IF NOT EXISTS users (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE IF NOT EXISTS groups (
+CREATE TABLE IF NOT EXISTS `groups` (
     id INT AUTO_INCREMENT PRIMARY KEY,
     group_name VARCHAR(255) NOT NULL,
     creator_id INT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seq BIGINT NOT NULL DEFAULT 0,
     FOREIGN KEY (creator_id) REFERENCES users(id)
 );
 
@@ -21,18 +22,35 @@ CREATE TABLE IF NOT EXISTS group_members (
     group_id INT NOT NULL,
     user_id INT NOT NULL,
     joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (group_id) REFERENCES groups(id),
+    FOREIGN KEY (group_id) REFERENCES `groups`(id),
     FOREIGN KEY (user_id) REFERENCES users(id),
-    UNIQUE KEY unique_member (group_id, user_id)
+    UNIQUE KEY unique_member (group_id, user_id),
+    INDEX idx_group_members_user (user_id, group_id)
 );
 
+-- Message id is the ordering key for history; timestamps only have one-second precision.
+-- seq numbers each group's messages for replay on reconnect (groups.last_seq is the counter);
+-- client_msg_id is the sender's id for the message, so a resent or retried INSERT is skipped
 CREATE TABLE IF NOT EXISTS messages (
-    id INT AUTO_INCREMENT PRIMARY KEY,
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
     sender_id INT NOT NULL,
     content TEXT NOT NULL,
     message_type INT NOT NULL,
     group_id INT,
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    seq BIGINT NOT NULL DEFAULT 0,
+    client_msg_id VARCHAR(64) NULL,
     FOREIGN KEY (sender_id) REFERENCES users(id),
-    FOREIGN KEY (group_id) REFERENCES groups(id)
-); 
\ No newline at end of file
+    FOREIGN KEY (group_id) REFERENCES `groups`(id),
+    INDEX idx_messages_group_id (group_id, id),
+    INDEX idx_messages_group_seq (group_id, seq),
+    UNIQUE KEY uq_messages_client_msg_id (sender_id, client_msg_id)
+);
+
+-- Migrations already included above; see migrate.py for upgrading existing databases
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT IGNORE INTO schema_migrations (version) VALUES (1), (2), (3), (4);
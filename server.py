@@ -1,144 +1,209 @@
 import grpc
-import mysql.connector
-import bcrypt
+import asyncio
+import argparse
+import os
+import secrets
+import shutil
+import signal
+import tempfile
+import multiprocessing
 from concurrent import futures
 import time
 import chat_pb2
 import chat_pb2_grpc
 from datetime import datetime
 import threading
-import queue
+from backplane import LocalBackplane, SocketBackplane
+from auth import AuthBusy, PasswordHasher, SESSION_METADATA_KEY, SessionManager
+from cache import ChatCache, OnlineMembers
+from logs import get_logger, setup_logging, shutdown_logging
+import metrics
+from persistence import MessageWriter
+from replay import DEDUP_MAX_IDS, GroupLog, RecentIds
+from outbound import (AsyncOutboundQueue, DROP_OLDEST, POLICIES, RESYNC_CONTENT, EncodedMessage, OutboundQueue,
+                      OutboundStats, serialize_chat_message)
+from storage import BACKENDS, DEFAULT_SQLITE_PATH, MySQLStorage, open_storage
+
+log = get_logger("server")
+
+# Group history paging
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_STREAM_CHUNK_SIZE = 200
+HISTORY_NO_CURSOR = 2 ** 63 - 1  # before_id used when the client asks for the newest messages
+
+# Replay on resume: a group that missed more than this is reloaded from history by the
+# client instead (a RESYNC notice for that group)
+REPLAY_MAX_PER_GROUP = 200
+
+# HTTP/2 keepalive. The server pings connections that have been quiet for KEEPALIVE_TIME_MS and
+# drops those that don't answer within KEEPALIVE_TIMEOUT_MS; that terminates their Chat stream,
+# which removes the user from active_users. Clients ping every 30s, so no application-level
+# heartbeats are needed to keep a stream open.
+KEEPALIVE_TIME_MS = 60_000
+KEEPALIVE_TIMEOUT_MS = 20_000
+KEEPALIVE_MIN_CLIENT_PING_MS = 20_000  # client pings more frequent than this count as abuse
+
+# Backstop for connections keepalive doesn't tear down (some gRPC releases never enforce the
+# ping timeout on a server): clients send a HEARTBEAT after 5 minutes of silence, so a stream
+# that has sent nothing for three times that is closed by the server.
+STREAM_IDLE_TIMEOUT = 900
+IDLE_SWEEP_INTERVAL = 60
 
 class ChatServicer(chat_pb2_grpc.ChatServiceServicer):
-    def __init__(self):
-        self.active_users = {}  # username -> stream
+    def __init__(self, pool_size=10, queue_size=1000, slow_consumer_policy=DROP_OLDEST, storage=None,
+                 password_workers=2, backplane=None):
+        self.active_users = {}  # username -> outbound queue of the user's Chat stream on this node
         self.message_queues = {}  # username -> queue
-        self.db = None
-        self.cursor = None
-        self.connect_db()
-        print("Chat server initialized")
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.outbound_stats = OutboundStats()
+        # bcrypt runs out of process; later RPCs only verify the session token from Login
+        self.password_hasher = PasswordHasher(workers=password_workers)
+        self.sessions = SessionManager()
+        # Users, groups and messages live behind a storage backend (see storage.py)
+        self.storage = storage or MySQLStorage(pool_size)
+        self.cache = ChatCache()
+        # Group id -> members whose stream is on this server; group fan-out walks only these
+        self.online_members = OnlineMembers()
+        # Messages are fanned out first and persisted in batches behind the scenes
+        self.message_writer = MessageWriter(self.storage.insert_messages)
+        self.message_writer.start()
+        # (sender, client_msg_id) of recent messages, so a resent message is fanned out once
+        self.recent_ids = RecentIds()
+        # Clients resend to a restarted server what they sent to the old one
+        self.recent_ids.load(((row['sender'], row['client_msg_id']), row['timestamp'])
+                             for row in self.storage.recent_client_msg_ids(DEDUP_MAX_IDS))
+        # Routes deliveries to users whose stream is on another server process
+        self.backplane = backplane or LocalBackplane()
+        self.backplane.start(self)
+        # Per-group sequence numbers, handed out by each group's owner node (this one, alone)
+        self.group_log = GroupLog(self.storage.last_seq)
+        self.stopping = threading.Event()
+        self.idle_sweeper = threading.Thread(target=self.sweep_idle_streams, name="idle-sweeper", daemon=True)
+        self.idle_sweeper.start()
+        self.register_metrics()
+        log.info("chat server initialized")
 
-    def connect_db(self):
-        try:
-            if self.db is not None:
-                try:
-                    self.db.close()
-                except:
-                    pass
-            
-            self.db = mysql.connector.connect(
-                host="localhost",
-                user="root",
-                password="root",
-                database="chat_db",
-                autocommit=True,
-                pool_name="mypool",
-                pool_size=5,
-                connect_timeout=60,
-                connection_timeout=60
-            )
-            self.db.ping(reconnect=True, attempts=3, delay=5)
-            self.cursor = self.db.cursor(dictionary=True)
-            print("Database connected successfully")
-        except Exception as e:
-            print(f"Error connecting to database: {e}")
-            raise
+    def register_metrics(self):
+        # Scrape-time views of state the server keeps anyway
+        metrics.callback("chat_active_streams", "Chat streams open on this server", "gauge",
+                         lambda: len(self.active_users))
+        metrics.callback("chat_outbound_queue_depth", "Messages waiting in a user's outbound queue (non-empty queues only)",
+                         "gauge", lambda: [({'user': user}, depth) for user, depth in self.queue_depths().items() if depth],
+                         ("user",))
+        metrics.callback("chat_outbound_queue_depth_max", "Deepest outbound queue on this server", "gauge",
+                         lambda: max(self.queue_depths().values(), default=0))
+        metrics.callback("chat_outbound_events_total", "Outbound queue events by kind", "counter",
+                         lambda: [({'event': event}, value) for event, value in self.outbound_stats.snapshot().items()],
+                         ("event",))
+        metrics.callback("chat_message_writer_total", "Write-behind message writer counters", "counter",
+                         lambda: [({'counter': name}, value) for name, value in self.message_writer.stats().items()],
+                         ("counter",))
+        metrics.callback("chat_db_pool_events_total", "Connection pool events", "counter",
+                         lambda: [({'event': event}, value) for event, value in self.storage.stats().items()
+                                  if not event.endswith("_ms")],
+                         ("event",))
 
-    def ensure_db_connection(self):
-        try:
-            self.db.ping(reconnect=True, attempts=3, delay=5)
-        except Exception as e:
-            print(f"Lost connection to database, reconnecting... Error: {e}")
-            self.connect_db()
-
-    def execute_query(self, query, params=None):
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                self.ensure_db_connection()
-                if params:
-                    self.cursor.execute(query, params)
-                else:
-                    self.cursor.execute(query)
-                return True
-            except mysql.connector.Error as err:
-                print(f"Database error (attempt {retry_count + 1}/{max_retries}): {err}")
-                retry_count += 1
-                if retry_count == max_retries:
-                    raise
-                time.sleep(1)  # Wait before retrying
-
-    def fetch_one(self, query, params=None):
-        self.execute_query(query, params)
-        return self.cursor.fetchone()
-
-    def fetch_all(self, query, params=None):
-        self.execute_query(query, params)
-        return self.cursor.fetchall()
+    def get_user_id(self, username):
+        return self.cache.get_user_id(username, self.storage.get_user_id)
+
+    def get_group_members(self, group_id):
+        return self.cache.get_members(group_id, self.storage.get_group_members)
+
+    def get_group_name(self, group_id):
+        return self.cache.get_group_name(group_id, self.storage.get_group_name)
+
+    def get_user_group_ids(self, username):
+        user_id = self.get_user_id(username)
+        if user_id is None:
+            return []
+        return [row['group_id'] for row in self.storage.get_user_groups(user_id)]
+
+    def close(self):
+        self.stopping.set()
+        # Flush buffered messages before storage is closed
+        self.message_writer.close()
+        log.info("message writer stats", **self.message_writer.stats())
+        log.info("outbound queue stats", **self.outbound_stats.snapshot())
+        log.info("storage stats", **self.storage.stats())
+        self.backplane.close()
+        self.storage.close()
+        self.password_hasher.close()
+
+    def session_user(self, context):
+        # Username from the request's session token, or None if it is missing or invalid
+        for key, value in context.invocation_metadata():
+            if key == SESSION_METADATA_KEY:
+                return self.sessions.verify(value)
+        return None
+
+    def authorized(self, context, username):
+        return self.session_user(context) == username
 
     def Register(self, request, context):
         try:
+            # "System" is the sender name of server notifications
+            if request.username == "System":
+                return chat_pb2.RegisterResponse(success=False, message="Username is reserved")
+
             # Check if username exists
-            user = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.username,))
-            if user:
+            if self.get_user_id(request.username) is not None:
                 return chat_pb2.RegisterResponse(success=False, message="Username already exists")
 
             # Hash password
-            password_hash = bcrypt.hashpw(request.password.encode(), bcrypt.gensalt())
+            password_hash = self.password_hasher.hash(request.password)
             
             # Insert new user
-            self.execute_query(
-                "INSERT INTO users (username, password_hash) VALUES (%s, %s)",
-                (request.username, password_hash)
-            )
-            self.db.commit()
+            user_id = self.storage.create_user(request.username, password_hash)
+            self.cache.set_user_id(request.username, user_id)
             
             return chat_pb2.RegisterResponse(success=True, message="Registration successful")
+        except AuthBusy as e:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            return chat_pb2.RegisterResponse(success=False, message=str(e))
         except Exception as e:
             return chat_pb2.RegisterResponse(success=False, message=str(e))
 
     def Login(self, request, context):
         try:
-            user = self.fetch_one(
-                "SELECT id, password_hash FROM users WHERE username = %s",
-                (request.username,)
-            )
+            user = self.storage.get_user(request.username)
             
             if not user:
                 return chat_pb2.LoginResponse(success=False, message="User not found")
             
-            if bcrypt.checkpw(request.password.encode(), user['password_hash'].encode()):
-                return chat_pb2.LoginResponse(success=True, message="Login successful")
+            if self.password_hasher.check(request.password, user['password_hash']):
+                return chat_pb2.LoginResponse(
+                    success=True,
+                    message="Login successful",
+                    session_token=self.sessions.issue(request.username)
+                )
             else:
                 return chat_pb2.LoginResponse(success=False, message="Invalid password")
+        except AuthBusy as e:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            return chat_pb2.LoginResponse(success=False, message=str(e))
         except Exception as e:
             return chat_pb2.LoginResponse(success=False, message=str(e))
 
     def CreateGroup(self, request, context):
+        if not self.authorized(context, request.creator):
+            return chat_pb2.CreateGroupResponse(success=False, message="Invalid session")
         try:
-            print(f"Creating group: {request.group_name} by {request.creator}")
+            log.info("creating group", group_name=request.group_name, creator=request.creator)
             # Get user ID
-            user = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.creator,))
-            if not user:
-                print(f"User {request.creator} not found")
+            user_id = self.get_user_id(request.creator)
+            if user_id is None:
+                log.warning("user not found", user=request.creator)
                 return chat_pb2.CreateGroupResponse(success=False, message="User not found")
 
-            # Create group
-            self.execute_query(
-                "INSERT INTO groups (group_name, creator_id) VALUES (%s, %s)",
-                (request.group_name, user['id'])
-            )
-            group_id = self.cursor.lastrowid
-
-            # Add creator as member
-            self.execute_query(
-                "INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
-                (group_id, user['id'])
-            )
-            self.db.commit()
-            print(f"Group created successfully with ID: {group_id}")
+            # Create group, with the creator as its first member
+            group_id = self.storage.create_group(request.group_name, user_id)
+            self.cache.set_group(group_id, request.group_name, [request.creator])
+            self.online_members.add_member(group_id, request.creator)
+            log.info("group created", group_id=group_id)
+            # Other sessions of the creator learn about the group from the stream
+            self.notify_group_change(request.creator, chat_pb2.GroupUpdate.ADDED, group_id, request.group_name)
 
             return chat_pb2.CreateGroupResponse(
                 success=True,
@@ -146,371 +211,920 @@ class ChatServicer(chat_pb2_grpc.ChatServiceServicer):
                 message="Group created successfully"
             )
         except Exception as e:
-            print(f"Error creating group: {e}")
+            log.exception("error creating group")
             return chat_pb2.CreateGroupResponse(success=False, message=str(e))
 
     def JoinGroup(self, request, context):
+        if not self.authorized(context, request.username):
+            return chat_pb2.JoinGroupResponse(success=False, message="Invalid session")
         try:
+            group_id = int(request.group_id)
+
             # Get user ID
-            user = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.username,))
-            if not user:
+            user_id = self.get_user_id(request.username)
+            if user_id is None:
                 return chat_pb2.JoinGroupResponse(success=False, message="User not found")
 
             # Check if group exists
-            group = self.fetch_one("SELECT id FROM groups WHERE id = %s", (int(request.group_id),))
-            if not group:
+            group_name = self.get_group_name(group_id)
+            if group_name is None:
                 return chat_pb2.JoinGroupResponse(success=False, message="Group not found")
 
             # Check if user is already a member
-            membership = self.fetch_one("""
-                SELECT id FROM group_members WHERE group_id = %s AND user_id = %s
-            """, (int(request.group_id), user['id']))
-            if membership:
+            if request.username in self.get_group_members(group_id):
                 return chat_pb2.JoinGroupResponse(success=False, message="Already a member of this group")
 
-            # Add user to group
-            self.execute_query(
-                "INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
-                (int(request.group_id), user['id'])
-            )
-            self.db.commit()
+            # Add user to group. The client resumes the group from its seq as of now.
+            last_seq = self.current_seq(group_id)
+            self.storage.add_member(group_id, user_id)
+            self.cache.add_member(group_id, request.username)
+            self.online_members.add_member(group_id, request.username)
+            self.backplane.invalidate_group(group_id)
+            self.notify_group_change(request.username, chat_pb2.GroupUpdate.ADDED, group_id, group_name, last_seq)
 
-            return chat_pb2.JoinGroupResponse(success=True, message="Joined group successfully")
+            return chat_pb2.JoinGroupResponse(success=True, message="Joined group successfully",
+                                              group_name=group_name, last_seq=last_seq)
         except Exception as e:
             return chat_pb2.JoinGroupResponse(success=False, message=str(e))
 
     def LeaveGroup(self, request, context):
+        if not self.authorized(context, request.username):
+            return chat_pb2.LeaveGroupResponse(success=False, message="Invalid session")
         try:
+            group_id = int(request.group_id)
+
             # Get user ID
-            user = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.username,))
-            if not user:
+            user_id = self.get_user_id(request.username)
+            if user_id is None:
                 return chat_pb2.LeaveGroupResponse(success=False, message="User not found")
 
             # Remove user from group
-            self.execute_query(
-                "DELETE FROM group_members WHERE group_id = %s AND user_id = %s",
-                (int(request.group_id), user['id'])
-            )
-            self.db.commit()
+            self.storage.remove_member(group_id, user_id)
+            self.cache.remove_member(group_id, request.username)
+            self.online_members.remove_member(group_id, request.username)
+            self.backplane.invalidate_group(group_id)
+            self.notify_group_change(request.username, chat_pb2.GroupUpdate.REMOVED, group_id)
 
             return chat_pb2.LeaveGroupResponse(success=True, message="Left group successfully")
         except Exception as e:
             return chat_pb2.LeaveGroupResponse(success=False, message=str(e))
 
     def GetUserGroups(self, request, context):
+        if not self.authorized(context, request.username):
+            return chat_pb2.GetUserGroupsResponse(success=False, message="Invalid session")
         try:
-            print(f"Getting groups for user: {request.username}")
+            log.debug("getting user groups", user=request.username)
             # Get user ID
-            user = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.username,))
-            if not user:
-                print(f"User {request.username} not found")
+            user_id = self.get_user_id(request.username)
+            if user_id is None:
+                log.warning("user not found", user=request.username)
                 return chat_pb2.GetUserGroupsResponse(success=False, message="User not found")
 
             # Get all groups the user is a member of
-            groups = self.fetch_all("""
-                SELECT g.id as group_id, g.group_name 
-                FROM groups g 
-                JOIN group_members gm ON g.id = gm.group_id 
-                WHERE gm.user_id = %s
-            """, (user['id'],))
+            groups = self.storage.get_user_groups(user_id)
             
             group_infos = []
             for row in groups:
                 group_infos.append(chat_pb2.GroupInfo(
                     group_id=str(row['group_id']),
-                    group_name=row['group_name']
+                    group_name=row['group_name'],
+                    last_seq=self.current_seq(row['group_id'], row['last_seq'])
                 ))
-            print(f"Found {len(group_infos)} groups for user {request.username}")
+            log.debug("found user groups", user=request.username, count=len(group_infos))
 
             return chat_pb2.GetUserGroupsResponse(
                 success=True,
                 groups=group_infos
             )
         except Exception as e:
-            print(f"Error getting user groups: {e}")
+            log.exception("error getting user groups")
             return chat_pb2.GetUserGroupsResponse(success=False, message=str(e))
 
+    def message_info(self, row):
+        return chat_pb2.MessageInfo(
+            id=row['id'],
+            content=row['content'],
+            sender=row['sender'],
+            timestamp=int(row['timestamp'].timestamp())
+        )
+
     def GetGroupHistory(self, request, context):
+        username = self.session_user(context)
+        if username is None:
+            return chat_pb2.GetGroupHistoryResponse(success=False, message="Invalid session")
         try:
-            # Get messages for the group
-            messages = self.fetch_all("""
-                SELECT m.content, m.timestamp, u.username as sender
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.group_id = %s
-                ORDER BY m.timestamp ASC
-            """, (int(request.group_id),))
-            
-            message_infos = []
-            for row in messages:
-                message_infos.append(chat_pb2.MessageInfo(
-                    content=row['content'],
-                    sender=row['sender'],
-                    timestamp=int(row['timestamp'].timestamp())
-                ))
+            if username not in self.get_group_members(int(request.group_id)):
+                return chat_pb2.GetGroupHistoryResponse(success=False, message="You are not a member of this group")
+
+            limit = min(request.limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
+
+            # Keyset pagination, one extra row tells us whether there is more
+            if request.after_id:
+                # Catch-up sync: oldest first, starting right after the client's last-seen id
+                messages = self.storage.history_after(int(request.group_id), request.after_id, limit + 1)
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+            else:
+                # Newest page first, walking backwards with before_id
+                before_id = request.before_id or HISTORY_NO_CURSOR
+                messages = self.storage.history_before(int(request.group_id), before_id, limit + 1)
+                has_more = len(messages) > limit
+                messages = list(reversed(messages[:limit]))
+
+            message_infos = [self.message_info(row) for row in messages]
 
             return chat_pb2.GetGroupHistoryResponse(
                 success=True,
-                messages=message_infos
+                messages=message_infos,
+                has_more=has_more
             )
         except Exception as e:
             return chat_pb2.GetGroupHistoryResponse(success=False, message=str(e))
 
-    def Chat(self, request_iterator, context):
-        username = None
-        print("New chat connection established")
-        
-        def send_message(message):
-            try:
-                # Skip processing for heartbeat messages
-                if message.type == chat_pb2.HEARTBEAT:
-                    return
+    def StreamGroupHistory(self, request, context):
+        # Sends the history older than before_id in chronological chunks, each one as soon as
+        # it is read from the cursor, so neither side holds the whole history in memory
+        username = self.session_user(context)
+        if username is None:
+            yield chat_pb2.GetGroupHistoryResponse(success=False, message="Invalid session")
+            return
+        try:
+            if username not in self.get_group_members(int(request.group_id)):
+                yield chat_pb2.GetGroupHistoryResponse(success=False, message="You are not a member of this group")
+                return
+            chunk_size = min(request.limit or HISTORY_STREAM_CHUNK_SIZE, HISTORY_MAX_PAGE_SIZE)
+            before_id = request.before_id or HISTORY_NO_CURSOR
+            for chunk in self.storage.stream_history(int(request.group_id), before_id, chunk_size):
+                yield chat_pb2.GetGroupHistoryResponse(
+                    success=True,
+                    messages=[self.message_info(row) for row in chunk]
+                )
+        except Exception as e:
+            log.exception("error streaming group history")
+            yield chat_pb2.GetGroupHistoryResponse(success=False, message=str(e))
 
-                print(f"Processing message from {message.sender} to group {message.group_id}")
-                
-                # Get sender's user ID
-                sender = self.fetch_one("SELECT id FROM users WHERE username = %s", (message.sender,))
-                if not sender:
-                    print(f"Error: Sender {message.sender} not found")
-                    return
+    def new_outbound_queue(self):
+        return OutboundQueue(
+            maxsize=self.queue_size,
+            policy=self.slow_consumer_policy,
+            stats=self.outbound_stats,
+            resync_message=self.resync_message()
+        )
 
-                # Nếu là tin nhắn hệ thống, gửi cho tất cả người dùng đang online
-                if message.sender == "System":
-                    print("Processing system message")
-                    for username in self.active_users:
-                        try:
-                            print(f"Sending system message to {username}")
-                            self.active_users[username].put(message)
-                        except Exception as e:
-                            print(f"Error sending system message to {username}: {e}")
-                    return
+    def resync_message(self, group_id=""):
+        # Sent in place of a discarded backlog (or of one group's missed messages); the client
+        # reloads history from the server
+        return chat_pb2.ChatMessage(
+            sender="System",
+            content=RESYNC_CONTENT,
+            type=chat_pb2.GROUP,
+            group_id=group_id
+        )
 
-                # Check if sender is a member of the group
-                membership = self.fetch_one("""
-                    SELECT gm.id, g.group_name 
-                    FROM group_members gm 
-                    JOIN groups g ON g.id = gm.group_id
-                    WHERE gm.group_id = %s AND gm.user_id = %s
-                """, (int(message.group_id), sender['id']))
-                
-                if not membership:
-                    print(f"Error: {message.sender} is not a member of group {message.group_id}")
-                    return
+    def register_stream(self, username, user_queue):
+        # A reconnect replaces the user's previous stream, which is closed so it can finish
+        previous = self.active_users.get(username)
+        self.active_users[username] = user_queue
+        self.online_members.connect(username)
+        if previous is not None:
+            previous.close()
+        self.backplane.user_online(username)
+
+    def unregister_stream(self, username, user_queue):
+        if self.active_users.get(username) is user_queue:
+            del self.active_users[username]
+            self.online_members.disconnect(username)
+            self.backplane.user_offline(username)
+        if user_queue.dropped:
+            log.warning("slow consumer dropped messages", user=username, dropped=user_queue.dropped, policy=user_queue.policy)
+
+    def sweep_idle_streams(self):
+        while not self.stopping.wait(IDLE_SWEEP_INTERVAL):
+            now = time.monotonic()
+            for username, user_queue in list(self.active_users.items()):
+                idle = now - user_queue.last_active
+                if idle > STREAM_IDLE_TIMEOUT:
+                    # Ends the Chat stream, whose cleanup unregisters the user
+                    log.info("closing idle stream", user=username, idle_seconds=int(idle))
+                    self.outbound_stats.add('idle_closes')
+                    user_queue.close()
+
+    def queue_depths(self):
+        return {username: len(user_queue) for username, user_queue in list(self.active_users.items())}
+
+    def deliver_message(self, username, message):
+        # Push a message onto the user's outbound queue; their Chat stream wakes up and yields it
+        return self.deliver_to([username], message) > 0
+
+    def notify_group_change(self, username, action, group_id, group_name="", last_seq=0):
+        # Group list deltas ride the Chat stream, so clients patch their list instead of
+        # re-fetching it with GetUserGroups
+        update = chat_pb2.ChatMessage(
+            sender="System",
+            type=chat_pb2.GROUP_UPDATE,
+            group_id=str(group_id),
+            group_update=chat_pb2.GroupUpdate(action=action, group_name=group_name or "", last_seq=last_seq)
+        )
+        return self.deliver_message(username, update)
 
-                # Save message to database with transaction
+    def current_seq(self, group_id, stored_seq=None):
+        # Seq of the group's latest message, which clients seed their resume point with.
+        # groups.last_seq lags the message writer, so the seq seen here wins when there is one.
+        last_seq = self.group_log.last_seq(group_id)
+        if last_seq is not None:
+            return last_seq
+        return self.storage.last_seq(group_id) if stored_seq is None else stored_seq
+
+    def deliver_to(self, usernames, message):
+        # The message is serialized once: local streams write those bytes as they are, and
+        # users on other nodes get them through the backplane. Offline users are skipped.
+        # Returns how many recipients it was queued for.
+        delivered = 0
+        remote = []
+        encoded = EncodedMessage(message)
+        for username in usernames:
+            user_queue = self.active_users.get(username)
+            if user_queue is None:
+                remote.append(username)
+            elif user_queue.put(encoded):
+                delivered += 1
+        if remote:
+            delivered += len(self.backplane.forward(remote, encoded.data))
+        return delivered
+
+    def deliver_group(self, group_id, message, members):
+        # Queues a group message for the members online here, except the sender, and hands
+        # it to the other nodes once, which do the same for theirs. Returns how many local
+        # recipients it was queued for.
+        encoded = EncodedMessage(message)
+        delivered = self.deliver_online(group_id, encoded, members)
+        self.backplane.forward_group(group_id, encoded.data)
+        return delivered
+
+    def deliver_online(self, group_id, encoded, members):
+        delivered = 0
+        sender = encoded.message.sender
+        for username in self.online_members.get(group_id, self.get_group_members):
+            # The index can lag a LeaveGroup by a moment; members is the authority
+            if username == sender or username not in members:
+                continue
+            user_queue = self.active_users.get(username)
+            if user_queue is not None and user_queue.put(encoded):
+                delivered += 1
+        return delivered
+
+    # Backplane callbacks, invoked from its reader threads
+
+    def local_usernames(self):
+        return list(self.active_users)
+
+    def deliver_local(self, usernames, payload):
+        # The payload is already the wire encoding; it is parsed only for the queues' bookkeeping
+        message = EncodedMessage(chat_pb2.ChatMessage.FromString(payload), payload)
+        for username in usernames:
+            user_queue = self.active_users.get(username)
+            if user_queue is not None:
+                user_queue.put(message)
+
+    def replaced_remotely(self, username):
+        # The user opened a new stream on another node; end the one here
+        user_queue = self.active_users.pop(username, None)
+        if user_queue is not None:
+            self.online_members.disconnect(username)
+            user_queue.close()
+
+    def deliver_group_local(self, group_id, payload):
+        # A group message numbered by its owner node, for this node's online members. It is
+        # recorded like a local one, so this node can replay it and dedup its resends too.
+        try:
+            message = chat_pb2.ChatMessage.FromString(payload)
+            members = self.get_group_members(group_id)
+            if message.client_msg_id:
+                self.recent_ids.add((message.sender, message.client_msg_id))
+            with self.group_log.lock(group_id):
+                self.group_log.record(group_id, message)
+                self.deliver_online(group_id, EncodedMessage(message, payload), members)
+        except Exception:
+            log.exception("error delivering forwarded group message", group_id=group_id)
+
+    def publish_forwarded(self, payload):
+        # A group message that a client sent to another node, for us to number as the owner
+        try:
+            self.publish(chat_pb2.ChatMessage.FromString(payload))
+        except Exception:
+            log.exception("error publishing forwarded message")
+
+    def invalidate_group(self, group_id):
+        self.cache.invalidate_group(group_id)
+        self.online_members.invalidate_group(group_id)
+
+    def send_message(self, message):
+        try:
+            # Skip processing for heartbeat messages; group list updates only come from the server
+            if message.type in (chat_pb2.HEARTBEAT, chat_pb2.GROUP_UPDATE):
+                return
+
+            log.sampled("processing message", sender=message.sender, group_id=message.group_id)
+            
+            # Get sender's user ID
+            sender_id = self.get_user_id(message.sender)
+            if sender_id is None:
+                log.warning("sender not found", sender=message.sender)
+                return
+
+            # Nếu là tin nhắn hệ thống, gửi cho tất cả người dùng đang online
+            if message.sender == "System":
+                log.debug("processing system message")
                 try:
-                    self.execute_query("START TRANSACTION")
-                    self.execute_query(
-                        "INSERT INTO messages (sender_id, content, message_type, group_id, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-                        (
-                            sender['id'],
-                            message.content,
-                            message.type,
-                            int(message.group_id)
-                        )
-                    )
-                    self.db.commit()
-                    print(f"Message saved to database: {message.content}")
-                except Exception as e:
-                    self.db.rollback()
-                    print(f"Error saving message to database: {e}")
+                    self.deliver_to(list(self.active_users), message)
+                except Exception:
+                    log.exception("error sending system message")
+                return
+
+            message.ClearField("resume")
+            owner = self.backplane.group_owner(int(message.group_id))
+            if owner is not None:
+                # Another node numbers this group's messages and fans them out to every node.
+                # It also drops resends; one this node already saw fanned out needn't go there.
+                if message.client_msg_id and self.recent_ids.seen((message.sender, message.client_msg_id)):
+                    metrics.DUPLICATE_MESSAGES.inc()
+                    log.sampled("duplicate message dropped", sender=message.sender, client_msg_id=message.client_msg_id)
                     return
+                if not self.backplane.submit(owner, message.SerializeToString()):
+                    log.warning("group owner backlog full, message dropped", group_id=message.group_id, owner=owner)
+                return
+            self.publish(message)
 
-                # Get all current group members
-                members = self.fetch_all("""
-                    SELECT DISTINCT u.username 
-                    FROM users u 
-                    JOIN group_members gm ON u.id = gm.user_id 
-                    WHERE gm.group_id = %s
-                """, (int(message.group_id),))
-                
-                print(f"Sending group message to {len(members)} members")
-
-                # Send message to all online members except sender
-                for member in members:
-                    username = member['username']
-                    if username in self.active_users and username != message.sender:
-                        try:
-                            print(f"Sending to group member: {username}")
-                            self.active_users[username].put(message)
-                            print(f"Message queued for {username}")
-                        except Exception as e:
-                            print(f"Error sending message to {username}: {e}")
+        except Exception:
+            log.exception("error in send_message")
 
-            except Exception as e:
-                print(f"Error in send_message: {e}")
+    def publish(self, message):
+        # Numbers, fans out and stores a group message; this node owns its group
+        try:
+            sender_id = self.get_user_id(message.sender)
+            if sender_id is None:
+                log.warning("sender not found", sender=message.sender)
+                return
+
+            # Check if sender is a member of the group (cached; only the batched message INSERT hits MySQL)
+            group_id = int(message.group_id)
+            members = self.get_group_members(group_id)
+            if message.sender not in members:
+                log.warning("sender is not a group member", sender=message.sender, group_id=message.group_id)
+                return
+
+            # Clients resend recent messages after a reconnect; drop the ones we already took
+            if message.client_msg_id and not self.recent_ids.add((message.sender, message.client_msg_id)):
+                metrics.DUPLICATE_MESSAGES.inc()
+                log.sampled("duplicate message dropped", sender=message.sender, client_msg_id=message.client_msg_id)
+                return
+
+            sent_at = datetime.now()
+
+            # Numbering, fan-out and the hand-off to the writer happen under the group's lock,
+            # so streams and the database see each group's messages in seq order
+            with self.group_log.lock(group_id):
+                self.group_log.append(group_id, message)
+
+                # Send message to the online members except the sender, wherever their stream is
                 try:
-                    self.db.rollback()
-                except:
-                    pass
+                    delivered = self.deliver_group(group_id, message, members)
+                    metrics.MESSAGES.inc()
+                    metrics.FANOUT_RECIPIENTS.observe(delivered)
+                    log.sampled("message fanned out", group_id=group_id, members=len(members), delivered=delivered)
+                except Exception:
+                    log.exception("error sending group message", group_id=message.group_id)
+
+                # Save message to database; blocks only when the write-behind buffer is full
+                self.message_writer.submit((
+                    sender_id,
+                    message.content,
+                    message.type,
+                    group_id,
+                    sent_at,
+                    message.seq,
+                    message.client_msg_id or None
+                ))
+
+        except Exception:
+            log.exception("error publishing message")
 
-        # Handle incoming messages
-        for message in request_iterator:
+    def replay_messages(self, username, user_queue, resume):
+        # resume maps group id -> last seq the client received. Each group's missed messages
+        # go to the front of the new stream's queue; a group that
+        # missed too much gets a RESYNC notice instead, and the client reloads its history.
+        # At most half the queue is filled this way.
+        budget = self.queue_size // 2
+        missed = []
+        for key, seq in resume.items():
             try:
-                if not username:
-                    username = message.sender
-                    print(f"User {username} connected")
-                    # Tạo queue mới cho user
-                    self.active_users[username] = queue.Queue()
-                    print(f"Active users: {list(self.active_users.keys())}")
-                    
-                    # Gửi tin nhắn thông báo kết nối thành công
-                    connect_msg = chat_pb2.ChatMessage(
-                        sender="System",
-                        content="Connected to chat server",
-                        type=chat_pb2.GROUP,
-                        group_id=""
-                    )
-                    self.active_users[username].put(connect_msg)
-                    
-                    # Trigger cập nhật danh sách group
-                    update_msg = chat_pb2.ChatMessage(
-                        sender="System",
-                        content="UPDATE_GROUPS",
-                        type=chat_pb2.GROUP,
-                        group_id=""
-                    )
-                    self.active_users[username].put(update_msg)
-                
-                # Skip processing for empty/heartbeat messages
-                if message.type == chat_pb2.HEARTBEAT:
-                    print(f"Received heartbeat from {message.sender}")
-                elif message.content:
-                    print(f"Received message from {message.sender}: {message.content}")
-                    send_message(message)
-
-                # Yield any messages for this user
+                group_id = int(key)
+            except ValueError:
+                continue
+            if username not in self.get_group_members(group_id):
+                continue
+            limit = min(REPLAY_MAX_PER_GROUP, budget - len(missed))
+            messages = self.missed_messages(group_id, seq, limit, username)
+            if len(messages) > limit:
+                log.info("too many missed messages, resyncing group", user=username, group_id=group_id)
+                user_queue.put(self.resync_message(key))
+                continue
+            missed.extend(messages)
+        if missed:
+            replayed = user_queue.prepend(missed)
+            log.info("replaying missed messages", user=username, groups=len(resume), count=replayed)
+
+    def missed_messages(self, group_id, seq, limit, username):
+        # The group's messages after seq in order, at most limit + 1 of them. The user's own
+        # messages are left out: they never reach the user's stream, so its seq doesn't
+        # move past them and they would otherwise count against the limit on every resume.
+        with self.group_log.lock(group_id):
+            messages = self.group_log.since(group_id, seq)
+        if messages is not None:
+            return [message for message in messages if message.sender != username]
+        # Older than the buffer: read from the database, then add the newest messages that
+        # are buffered but may still be waiting in the message writer
+        messages = [self.replayed_message(group_id, row)
+                    for row in self.storage.messages_after_seq(group_id, seq, limit + 1, username)]
+        if len(messages) > limit:
+            return messages
+        stored_seq = None
+        if not messages and self.group_log.last_seq(group_id) is None:
+            # Clients resume every group they are in, so start tracking a quiet group here;
+            # the next resume of it is answered without the database
+            stored_seq = self.storage.last_seq(group_id)
+        with self.group_log.lock(group_id):
+            if stored_seq is not None:
+                self.group_log.start(group_id, stored_seq)
+            buffered = self.group_log.since(group_id, messages[-1].seq if messages else seq, partial=True)
+        return messages + [message for message in buffered if message.sender != username]
+
+    def replayed_message(self, group_id, row):
+        return chat_pb2.ChatMessage(
+            sender=row['sender'],
+            content=row['content'],
+            timestamp=row['timestamp'].isoformat(),
+            type=chat_pb2.GROUP,
+            group_id=str(group_id),
+            seq=row['seq']
+        )
+
+    def consume_messages(self, request_iterator, user_queue, username):
+        # Runs on its own thread so reading from the client never holds up delivery to it
+        try:
+            for message in request_iterator:
+                user_queue.last_active = time.monotonic()
                 try:
-                    while True:  # Thay đổi từ not self.active_users[username].empty()
-                        try:
-                            msg = self.active_users[username].get_nowait()
-                            print(f"Yielding message to {username}: {msg.content}")
-                            yield msg
-                        except queue.Empty:
-                            break
-                except Exception as e:
-                    print(f"Error yielding messages: {e}")
-                
-            except Exception as e:
-                print(f"Error processing message: {e}")
-            
-            # Small delay to prevent CPU overuse
-            time.sleep(0.1)
-        
-        # Remove user from active users when they disconnect
-        if username and username in self.active_users:
-            print(f"User {username} disconnected")
-            del self.active_users[username]
+                    if message.sender != username:
+                        log.warning("dropping message with forged sender", user=username, claimed_sender=message.sender)
+                    elif message.type != chat_pb2.HEARTBEAT and message.content:
+                        log.sampled("message received", sender=message.sender, group_id=message.group_id)
+                        self.send_message(message)
+                except Exception:
+                    log.exception("error processing message", user=username)
+        except Exception as e:
+            log.debug("inbound stream closed", user=username, error=e)
+        finally:
+            # Wake up the outbound loop so it can finish the stream
+            user_queue.close()
+
+    def Chat(self, request_iterator, context):
+
+        # The first message identifies the user (clients open the stream with a heartbeat)
+        try:
+            first_message = next(request_iterator)
+        except StopIteration:
+            return
+        username = first_message.sender
+        if not self.authorized(context, username):
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, "Invalid session")
+        log.info("user connected", user=username)
+
+        # Loaded before the stream is registered, so a failure here leaves nothing behind
+        changes = self.online_members.changes
+        group_ids = self.get_user_group_ids(username)
+
+        # Tạo queue mới cho user
+        user_queue = self.new_outbound_queue()
+        self.register_stream(username, user_queue)
+        # The user is registered now: whatever fails or ends the RPC from here on goes
+        # through the finally below, which unregisters them
+        try:
+            context.add_callback(user_queue.close)
+            if self.online_members.changes != changes:
+                # A membership changed while the list was loading, so it may be stale
+                group_ids = self.get_user_group_ids(username)
+            # Before the replay below, so nothing falls between it and live delivery
+            self.online_members.add_groups(username, group_ids)
+            log.debug("active users", count=len(self.active_users))
+
+            # Gửi tin nhắn thông báo kết nối thành công
+            user_queue.put(chat_pb2.ChatMessage(
+                sender="System",
+                content="Connected to chat server",
+                type=chat_pb2.GROUP,
+                group_id=""
+            ))
+
+            # Trigger cập nhật toàn bộ danh sách group (bù cho các thay đổi bị lỡ khi mất kết nối)
+            user_queue.put(chat_pb2.ChatMessage(
+                sender="System",
+                content="UPDATE_GROUPS",
+                type=chat_pb2.GROUP,
+                group_id=""
+            ))
+
+            # Gửi lại các tin nhắn bị lỡ trong lúc mất kết nối
+            if first_message.resume:
+                self.replay_messages(username, user_queue, first_message.resume)
+
+            if first_message.type != chat_pb2.HEARTBEAT and first_message.content:
+                self.send_message(first_message)
+
+            consumer = threading.Thread(
+                target=self.consume_messages,
+                args=(request_iterator, user_queue, username),
+                daemon=True
+            )
+            consumer.start()
+
+            # Block on the user's queue and yield as soon as something arrives;
+            # None means the queue was closed (inbound side finished, RPC terminated or slow consumer)
+            while True:
+                msg = user_queue.get()
+                if msg is None:
+                    break
+                yield msg
+            if user_queue.overflowed:
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Outbound buffer full, reconnect and reload history")
+        finally:
+            # Remove user from active users when they disconnect, unless they already reconnected
+            self.unregister_stream(username, user_queue)
+            log.info("user disconnected", user=username)
 
     def InviteUser(self, request, context):
+        if not self.authorized(context, request.inviter):
+            return chat_pb2.InviteUserResponse(success=False, message="Invalid session")
         try:
-            print(f"Inviting user {request.invitee} to group {request.group_id} by {request.inviter}")
+            log.info("inviting user", invitee=request.invitee, group_id=request.group_id, inviter=request.inviter)
             
+            group_id = int(request.group_id)
+
             # Check if inviter is a member of the group
-            inviter_data = self.fetch_one("""
-                SELECT u.id, g.group_name FROM users u
-                JOIN group_members gm ON u.id = gm.user_id
-                JOIN groups g ON g.id = gm.group_id
-                WHERE u.username = %s AND gm.group_id = %s
-            """, (request.inviter, int(request.group_id)))
-            if not inviter_data:
-                print(f"User {request.inviter} is not a member of group {request.group_id}")
+            if request.inviter not in self.get_group_members(group_id):
+                log.warning("inviter is not a group member", inviter=request.inviter, group_id=request.group_id)
                 return chat_pb2.InviteUserResponse(success=False, message="You are not a member of this group")
 
             # Check if invitee exists
-            invitee = self.fetch_one("SELECT id FROM users WHERE username = %s", (request.invitee,))
-            if not invitee:
-                print(f"User {request.invitee} not found")
+            invitee_id = self.get_user_id(request.invitee)
+            if invitee_id is None:
+                log.warning("user not found", user=request.invitee)
                 return chat_pb2.InviteUserResponse(success=False, message="User not found")
 
             # Check if invitee is already a member
-            membership = self.fetch_one("""
-                SELECT id FROM group_members 
-                WHERE group_id = %s AND user_id = %s
-            """, (int(request.group_id), invitee['id']))
-            if membership:
-                print(f"User {request.invitee} is already a member of group {request.group_id}")
+            if request.invitee in self.get_group_members(group_id):
+                log.info("invitee already a member", invitee=request.invitee, group_id=request.group_id)
                 return chat_pb2.InviteUserResponse(success=False, message="User is already a member of this group")
 
-            # Start transaction
-            self.execute_query("START TRANSACTION")
             try:
                 # Add invitee to group
-                self.execute_query(
-                    "INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
-                    (int(request.group_id), invitee['id'])
-                )
+                last_seq = self.current_seq(group_id)
+                self.storage.add_member(group_id, invitee_id)
+                self.cache.add_member(group_id, request.invitee)
+                self.online_members.add_member(group_id, request.invitee)
+                self.backplane.invalidate_group(group_id)
                 
                 # Get group name for notifications
-                group_name = inviter_data['group_name']
-                
-                # Commit transaction
-                self.db.commit()
-                print(f"User {request.invitee} added to group {request.group_id}")
-
-                # Gửi thông báo cho người được mời
-                if request.invitee in self.active_users:
-                    invite_notification = chat_pb2.ChatMessage(
-                        sender="System",
-                        content=f"You have been invited to group '{group_name}' by {request.inviter}",
-                        type=chat_pb2.GROUP,
-                        group_id=request.group_id
-                    )
-                    self.active_users[request.invitee].put(invite_notification)
-
-                    # Gửi thêm một message đặc biệt để trigger cập nhật danh sách group
-                    update_trigger = chat_pb2.ChatMessage(
-                        sender="System",
-                        content="UPDATE_GROUPS",
-                        type=chat_pb2.GROUP,
-                        group_id=""
-                    )
-                    self.active_users[request.invitee].put(update_trigger)
+                group_name = self.get_group_name(group_id)
+                log.info("user added to group", invitee=request.invitee, group_id=request.group_id)
+
+                # Gửi thông báo cho người được mời (trên node nào đang giữ stream của họ)
+                invite_notification = chat_pb2.ChatMessage(
+                    sender="System",
+                    content=f"You have been invited to group '{group_name}' by {request.inviter}",
+                    type=chat_pb2.GROUP,
+                    group_id=request.group_id
+                )
+                self.deliver_message(request.invitee, invite_notification)
+                # Gửi thay đổi danh sách group để client tự thêm group mới, không cần tải lại
+                self.notify_group_change(request.invitee, chat_pb2.GroupUpdate.ADDED, group_id, group_name, last_seq)
 
                 # Thông báo cho các thành viên khác trong group
-                members = self.fetch_all("""
-                    SELECT u.username FROM users u
-                    JOIN group_members gm ON u.id = gm.user_id
-                    WHERE gm.group_id = %s AND u.username != %s
-                """, (int(request.group_id), request.invitee))
-                
-                member_notifications = []
-                for member in members:
-                    if member['username'] in self.active_users:
-                        member_notifications.append(chat_pb2.ChatMessage(
-                            sender="System",
-                            content=f"{request.invitee} has joined the group '{group_name}'",
-                            type=chat_pb2.GROUP,
-                            group_id=request.group_id
-                        ))
-                        self.active_users[member['username']].put(member_notifications[-1])
+                members = self.get_group_members(group_id) - {request.invitee}
+                member_notification = chat_pb2.ChatMessage(
+                    sender="System",
+                    content=f"{request.invitee} has joined the group '{group_name}'",
+                    type=chat_pb2.GROUP,
+                    group_id=request.group_id
+                )
+                self.deliver_to(members, member_notification)
 
                 return chat_pb2.InviteUserResponse(success=True, message=f"User {request.invitee} has been invited to the group")
 
             except Exception as e:
-                self.db.rollback()
-                print(f"Database error while inviting user: {e}")
+                log.exception("database error while inviting user")
                 return chat_pb2.InviteUserResponse(success=False, message=f"Failed to invite user: {str(e)}")
 
         except Exception as e:
-            print(f"Error inviting user: {e}")
+            log.exception("error inviting user")
             return chat_pb2.InviteUserResponse(success=False, message=str(e))
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    chat_pb2_grpc.add_ChatServiceServicer_to_server(ChatServicer(), server)
-    port = 50051
+class AsyncChatServicer(ChatServicer):
+    # grpc.aio variant: each Chat stream is a coroutine fed by an asyncio queue, so an open
+    # stream no longer holds a worker thread. Unary RPCs are inherited unchanged and run on
+    # the server's migration thread pool; database work started from coroutines goes
+    # through run_db, which runs it on a dedicated DB executor.
+    def __init__(self, pool_size=10, queue_size=1000, slow_consumer_policy=DROP_OLDEST, storage=None,
+                 password_workers=2, backplane=None):
+        super().__init__(pool_size, queue_size, slow_consumer_policy, storage, password_workers, backplane)
+        self.loop = None
+        # One executor thread per pooled connection, so DB calls never queue on the pool itself
+        self.db_executor = futures.ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+
+    async def run_db(self, func, *args):
+        return await self.loop.run_in_executor(self.db_executor, func, *args)
+
+    def new_outbound_queue(self):
+        # put() is called from worker threads (unary RPCs, DB executor) as well as from the loop
+        return AsyncOutboundQueue(
+            self.loop,
+            maxsize=self.queue_size,
+            policy=self.slow_consumer_policy,
+            stats=self.outbound_stats,
+            resync_message=self.resync_message()
+        )
+
+    async def consume_messages_async(self, request_iterator, user_queue, username):
+        try:
+            async for message in request_iterator:
+                user_queue.last_active = time.monotonic()
+                try:
+                    if message.sender != username:
+                        log.warning("dropping message with forged sender", user=username, claimed_sender=message.sender)
+                    elif message.type != chat_pb2.HEARTBEAT and message.content:
+                        log.sampled("message received", sender=message.sender, group_id=message.group_id)
+                        await self.run_db(self.send_message, message)
+                except Exception:
+                    log.exception("error processing message", user=username)
+        except Exception as e:
+            log.debug("inbound stream closed", user=username, error=e)
+        finally:
+            user_queue.close()
+
+    async def Chat(self, request_iterator, context):
+
+        try:
+            first_message = await request_iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        username = first_message.sender
+        if not self.authorized(context, username):
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, "Invalid session")
+        log.info("user connected", user=username)
+
+        changes = self.online_members.changes
+        group_ids = await self.run_db(self.get_user_group_ids, username)
+
+        user_queue = self.new_outbound_queue()
+        self.register_stream(username, user_queue)
+        consumer = None
+        # Cancellation of the RPC raises CancelledError at any await below, which runs the cleanup
+        try:
+            if self.online_members.changes != changes:
+                group_ids = await self.run_db(self.get_user_group_ids, username)
+            self.online_members.add_groups(username, group_ids)
+            log.debug("active users", count=len(self.active_users))
+
+            user_queue.put(chat_pb2.ChatMessage(
+                sender="System",
+                content="Connected to chat server",
+                type=chat_pb2.GROUP,
+                group_id=""
+            ))
+            user_queue.put(chat_pb2.ChatMessage(
+                sender="System",
+                content="UPDATE_GROUPS",
+                type=chat_pb2.GROUP,
+                group_id=""
+            ))
+            if first_message.resume:
+                await self.run_db(self.replay_messages, username, user_queue, first_message.resume)
+
+            if first_message.type != chat_pb2.HEARTBEAT and first_message.content:
+                await self.run_db(self.send_message, first_message)
+
+            consumer = asyncio.create_task(self.consume_messages_async(request_iterator, user_queue, username))
+
+            while True:
+                msg = await user_queue.get_async()
+                if msg is None:
+                    break
+                yield msg
+            if user_queue.overflowed:
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Outbound buffer full, reconnect and reload history")
+        finally:
+            if consumer is not None:
+                consumer.cancel()
+            self.unregister_stream(username, user_queue)
+            log.info("user disconnected", user=username)
+
+def server_options(reuse_port):
+    options = [
+        ("grpc.keepalive_time_ms", KEEPALIVE_TIME_MS),
+        ("grpc.keepalive_timeout_ms", KEEPALIVE_TIMEOUT_MS),
+        ("grpc.keepalive_permit_without_calls", 1),
+        # An idle Chat stream carries no data, so keepalive pings must not be capped
+        ("grpc.http2.max_pings_without_data", 0),
+        ("grpc.http2.min_ping_interval_without_data_ms", KEEPALIVE_MIN_CLIENT_PING_MS),
+        ("grpc.http2.max_ping_strikes", 2),
+    ]
+    if reuse_port:
+        # Worker processes of one launcher all bind the same port; the kernel spreads connections
+        options.append(("grpc.so_reuseport", 1))
+    return options
+
+def add_chat_service(servicer, server):
+    # Chat gets a handler of its own, registered ahead of the generated ones so it takes
+    # precedence: its serializer passes EncodedMessage bytes through, so a group message is
+    # encoded once however many streams it is written to
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler("chat.ChatService", {
+        "Chat": grpc.stream_stream_rpc_method_handler(
+            servicer.Chat,
+            request_deserializer=chat_pb2.ChatMessage.FromString,
+            response_serializer=serialize_chat_message,
+        ),
+    }),))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+
+def serve(servicer, port=50051, max_workers=10, reuse_port=False):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), options=server_options(reuse_port),
+                         interceptors=[metrics.MetricsInterceptor()])
+    add_chat_service(servicer, server)
     server.add_insecure_port(f'[::]:{port}')
     server.start()
-    print(f"Server started on port {port}")
+    log.info("server started", port=port)
     print("Press Ctrl+C to stop the server")
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
-        print("\nShutting down server...")
+        log.info("shutting down server")
         server.stop(0)
-        print("Server stopped")
+        servicer.close()
+        log.info("server stopped")
+
+async def serve_async(servicer, port=50051, unary_workers=50, reuse_port=False):
+    servicer.loop = asyncio.get_running_loop()
+    # Non-async handlers (all unary RPCs) run on the migration pool; Chat streams stay on the loop
+    server = grpc.aio.server(migration_thread_pool=futures.ThreadPoolExecutor(max_workers=unary_workers),
+                             options=server_options(reuse_port), interceptors=[metrics.AsyncMetricsInterceptor()])
+    add_chat_service(servicer, server)
+    server.add_insecure_port(f'[::]:{port}')
+    await server.start()
+    # Ctrl+C and SIGTERM stop the server from inside the loop, so the cleanup below runs
+    # normally instead of being cancelled along with the main task
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        servicer.loop.add_signal_handler(signum, lambda: asyncio.ensure_future(server.stop(0)))
+    log.info("async server started", port=port)
+    print("Press Ctrl+C to stop the server")
+    try:
+        await server.wait_for_termination()
+    finally:
+        log.info("shutting down server")
+        await server.stop(0)
+        servicer.db_executor.shutdown(wait=True)
+        servicer.close()
+        log.info("server stopped")
+
+def run(args, backplane=None, reuse_port=False, worker_index=0):
+    if args.metrics_port:
+        # Workers of one launcher each get their own port: metrics-port + worker index
+        metrics.start_http_server(args.metrics_port + worker_index, args.metrics_host)
+    storage = open_storage(args.storage, args.db_pool_size, args.db_path)
+    if args.mode == "aio":
+        servicer = AsyncChatServicer(args.db_pool_size, args.outbound_queue_size, args.slow_consumer_policy,
+                                     storage=storage, password_workers=args.password_workers, backplane=backplane)
+        try:
+            asyncio.run(serve_async(servicer, args.port, reuse_port=reuse_port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        servicer = ChatServicer(args.db_pool_size, args.outbound_queue_size, args.slow_consumer_policy,
+                                storage=storage, password_workers=args.password_workers, backplane=backplane)
+        serve(servicer, args.port, reuse_port=reuse_port)
+
+def interrupt(signum, frame):
+    # Lets SIGTERM take the same shutdown path as Ctrl+C (aio servers handle it on their loop)
+    raise KeyboardInterrupt
+
+def run_worker(args, node_addresses, index):
+    # Worker process entry point: one full server on the shared port, linked to its
+    # siblings over unix sockets so group delivery works whichever worker holds a stream.
+    # Ctrl+C reaches the whole process group, so workers ignore SIGINT and shut down
+    # once, when the launcher sends SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    setup_logging(args.log_level, args.log_format == "json", args.log_sample)
+    log.info("worker starting", worker=index, pid=os.getpid())
+    peers = [address for address in node_addresses if address != node_addresses[index]]
+    try:
+        run(args, SocketBackplane(node_addresses[index], peers), reuse_port=True, worker_index=index)
+    finally:
+        shutdown_logging()
+
+def run_workers(args):
+    # Launcher: starts args.workers server processes on the same port and restarts any that
+    # die. Workers are spawned, not forked, so none of them inherits gRPC or MySQL state.
+    # They must accept each other's session tokens, so they share one secret.
+    os.environ.setdefault("CHAT_SESSION_SECRET", secrets.token_hex(32))
+    # A service manager stops the launcher with SIGTERM; take the workers down with it and
+    # remove their sockets, as on Ctrl+C
+    signal.signal(signal.SIGTERM, interrupt)
+    socket_dir = tempfile.mkdtemp(prefix="chat-workers-")
+    node_addresses = [f"unix:{os.path.join(socket_dir, f'worker-{i}.sock')}" for i in range(args.workers)]
+    context = multiprocessing.get_context("spawn")
+
+    def start(index):
+        process = context.Process(target=run_worker, args=(args, node_addresses, index), name=f"chat-worker-{index}")
+        process.start()
+        return process
+
+    workers = []
+    try:
+        workers.extend(start(index) for index in range(args.workers))
+        log.info("started workers", workers=args.workers, port=args.port)
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(workers):
+                if not process.is_alive():
+                    log.error("worker exited, restarting", worker=index, exitcode=process.exitcode)
+                    workers[index] = start(index)
+    except KeyboardInterrupt:
+        # Give the workers time to flush buffered messages and stop
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+        for process in workers:
+            process.join(30)
+            if process.is_alive():
+                process.kill()
+        log.info("all workers stopped")
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="gRPC chat server")
+    parser.add_argument("--mode", choices=["thread", "aio"], default="thread",
+                        help="thread: one worker thread per RPC (default); aio: asyncio server for many concurrent Chat streams")
+    parser.add_argument("--port", type=int, default=50051, help="port to listen on (default: 50051)")
+    parser.add_argument("--storage", choices=BACKENDS, default="mysql",
+                        help="mysql: the database in db.DB_CONFIG (default); sqlite: a local file, see --db-path; "
+                             "memory: nothing is kept after the server stops")
+    parser.add_argument("--db-path", default=DEFAULT_SQLITE_PATH,
+                        help=f"SQLite database file for --storage sqlite (default: {DEFAULT_SQLITE_PATH})")
+    parser.add_argument("--db-pool-size", type=int, default=10,
+                        help="number of pooled database connections (default: 10)")
+    parser.add_argument("--outbound-queue-size", type=int, default=1000,
+                        help="messages buffered per connected client before the slow-consumer policy applies (default: 1000)")
+    parser.add_argument("--slow-consumer-policy", choices=POLICIES, default=DROP_OLDEST,
+                        help="what happens when a client's buffer is full (default: drop_oldest)")
+    parser.add_argument("--password-workers", type=int, default=2,
+                        help="processes used for bcrypt hashing on Register/Login (default: 2)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server processes sharing the port via SO_REUSEPORT, one per core is a good start (default: 1)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics at http://<metrics-host>:<port>/metrics (with --workers, one port per worker from here)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="interface for the metrics endpoint (default: 127.0.0.1)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="log level (default: $CHAT_LOG_LEVEL or INFO); per-message events are logged at DEBUG")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text", help="log line format (default: text)")
+    parser.add_argument("--log-sample", type=int,
+                        help="log 1 in N per-message events at DEBUG (default: $CHAT_LOG_SAMPLE or 100)")
+    parser.add_argument("--node-address",
+                        help="host:port this server listens on for other server processes; enables multi-node fan-out")
+    parser.add_argument("--peers", default="",
+                        help="comma-separated node addresses of the other server processes")
+    args = parser.parse_args()
+    if args.workers > 1 and args.node_address:
+        parser.error("--workers cannot be combined with --node-address")
+    if args.node_address and not os.environ.get("CHAT_SESSION_SECRET"):
+        parser.error("--node-address needs CHAT_SESSION_SECRET, set to the same value on every node")
+    if args.storage == "memory" and (args.workers > 1 or args.node_address):
+        parser.error("--storage memory keeps data inside one process; use sqlite or mysql with several")
+
+    setup_logging(args.log_level, args.log_format == "json", args.log_sample)
+    try:
+        if args.workers > 1:
+            run_workers(args)
+            return
+
+        backplane = None
+        if args.node_address:
+            peers = [peer.strip() for peer in args.peers.split(",") if peer.strip()]
+            backplane = SocketBackplane(args.node_address, peers)
+        run(args, backplane)
+    finally:
+        shutdown_logging()
 
 if __name__ == '__main__':
-    serve() 
\ No newline at end of file
+    main() 
\ No newline at end of file
@@ -0,0 +1,400 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+
+import metrics
+from db import (CREATE_GROUP_QUERY, ConnectionPool, DB_CONFIG, GROUP_HISTORY_AFTER_QUERY, GROUP_HISTORY_PAGE_QUERY,
+                GROUP_LAST_SEQ_QUERY, GROUP_REPLAY_QUERY, RECENT_CLIENT_IDS_QUERY, SQLitePool, USER_GROUPS_QUERY)
+from logs import get_logger
+
+log = get_logger("storage")
+
+# Storage backends for ChatServicer: users, groups, memberships and messages. All three have
+# the same methods and return rows as dicts with the column names of the SQL schema:
+#   MySQLStorage   the MySQL database from DB_CONFIG, through a connection pool
+#   SQLiteStorage  one SQLite file in WAL mode (several processes may share it), or ":memory:"
+#   MemoryStorage  plain Python dicts, gone when the process exits
+BACKENDS = ("mysql", "sqlite", "memory")
+DEFAULT_SQLITE_PATH = "chat.sqlite3"
+
+GROUP_MEMBERS_QUERY = """
+    SELECT u.username
+    FROM users u
+    JOIN group_members gm ON u.id = gm.user_id
+    WHERE gm.group_id = %s
+"""
+
+GROUP_HISTORY_STREAM_QUERY = """
+    SELECT m.id, m.content, m.timestamp, u.username as sender
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.group_id = %s AND m.id < %s
+    ORDER BY m.id ASC
+"""
+
+
+def open_storage(backend, pool_size=10, path=DEFAULT_SQLITE_PATH):
+    if backend == "mysql":
+        return MySQLStorage(pool_size)
+    if backend == "sqlite":
+        return SQLiteStorage(path, pool_size)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class SQLStorage:
+    # Runs the chat queries on a ConnectionPool (or a pool with the same interface, like
+    # SQLitePool). Each call checks out its own connection, so concurrent RPCs never share
+    # a cursor; statements are timed per statement label and retried on MySQL errors.
+    max_retries = 3
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def execute(self, query, params=None, fetch=None):
+        retry_count = 0
+        statement = metrics.statement_label(query)
+        while retry_count < self.max_retries:
+            try:
+                with self.pool.connection() as conn:
+                    cursor = conn.cursor(dictionary=True, buffered=True)
+                    start = time.perf_counter()
+                    try:
+                        cursor.execute(query, params or ())
+                        if fetch == "one":
+                            return cursor.fetchone()
+                        if fetch == "all":
+                            return cursor.fetchall()
+                        return cursor.lastrowid
+                    finally:
+                        metrics.DB_QUERY_DURATION.observe(time.perf_counter() - start, statement=statement)
+                        cursor.close()
+            except mysql.connector.Error as err:
+                log.warning("database error", statement=statement, attempt=retry_count + 1,
+                            max_retries=self.max_retries, error=err)
+                retry_count += 1
+                if retry_count == self.max_retries:
+                    metrics.DB_ERRORS.inc(statement=statement)
+                    raise
+                metrics.DB_RETRIES.inc(statement=statement)
+                time.sleep(1)  # Wait before retrying
+
+    def fetch_one(self, query, params=None):
+        return self.execute(query, params, fetch="one")
+
+    def fetch_all(self, query, params=None):
+        return self.execute(query, params, fetch="all")
+
+    @contextmanager
+    def transaction(self):
+        # Runs several statements on one connection; commits on success, rolls back on error
+        with self.pool.connection() as conn:
+            conn.start_transaction()
+            cursor = conn.cursor(dictionary=True, buffered=True)
+            start = time.perf_counter()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                metrics.DB_QUERY_DURATION.observe(time.perf_counter() - start, statement="TRANSACTION")
+                cursor.close()
+
+    def stream_query(self, query, params, chunk_size):
+        # Yields rows in chunks straight off an unbuffered cursor. The connection stays checked
+        # out until the last chunk is consumed; if the caller stops early it is replaced, since
+        # it still has unread rows pending.
+        conn = self.pool.acquire()
+        completed = False
+        try:
+            cursor = conn.cursor(dictionary=True)
+            start = time.perf_counter()
+            cursor.execute(query, params)
+            metrics.DB_QUERY_DURATION.observe(time.perf_counter() - start, statement=metrics.statement_label(query))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+            completed = True
+        finally:
+            if completed:
+                self.pool.release(conn)
+            else:
+                self.pool.replace(conn)
+
+    # Users
+
+    def get_user(self, username):
+        return self.fetch_one("SELECT id, password_hash FROM users WHERE username = %s", (username,))
+
+    def get_user_id(self, username):
+        user = self.fetch_one("SELECT id FROM users WHERE username = %s", (username,))
+        return user['id'] if user else None
+
+    def create_user(self, username, password_hash):
+        return self.execute("INSERT INTO users (username, password_hash) VALUES (%s, %s)", (username, password_hash))
+
+    # Groups and memberships
+
+    def create_group(self, group_name, creator_id):
+        # The group and its creator's membership are written together
+        with self.transaction() as cursor:
+            cursor.execute(CREATE_GROUP_QUERY, (group_name, creator_id))
+            group_id = cursor.lastrowid
+            cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)", (group_id, creator_id))
+        return group_id
+
+    def get_group_name(self, group_id):
+        group = self.fetch_one("SELECT group_name FROM `groups` WHERE id = %s", (group_id,))
+        return group['group_name'] if group else None
+
+    def get_group_members(self, group_id):
+        return [row['username'] for row in self.fetch_all(GROUP_MEMBERS_QUERY, (group_id,))]
+
+    def add_member(self, group_id, user_id):
+        self.execute("INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)", (group_id, user_id))
+
+    def remove_member(self, group_id, user_id):
+        self.execute("DELETE FROM group_members WHERE group_id = %s AND user_id = %s", (group_id, user_id))
+
+    def get_user_groups(self, user_id):
+        return self.fetch_all(USER_GROUPS_QUERY, (user_id,))
+
+    # Group sequence numbers
+
+    def last_seq(self, group_id):
+        group = self.fetch_one(GROUP_LAST_SEQ_QUERY, (group_id,))
+        return group['last_seq'] if group else 0
+
+    # Messages
+
+    def insert_messages(self, rows):
+        # One multi-row INSERT for a batch of (sender_id, content, message_type, group_id, timestamp, seq,
+        # client_msg_id), then one UPDATE that moves each group's counter up to the highest seq stored.
+        # The unique key on (sender_id, client_msg_id) makes the INSERT safe to retry: rows that
+        # already made it in are skipped. The counter is read back from messages rather than taken
+        # from the batch, so a skipped duplicate doesn't leave it pointing at a seq that was never stored.
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+        params = [value for row in rows for value in row]
+        self.execute(
+            "INSERT IGNORE INTO messages (sender_id, content, message_type, group_id, timestamp, seq, client_msg_id) "
+            "VALUES " + placeholders,
+            params
+        )
+        group_ids = list({row[3] for row in rows})
+        self.execute(
+            "UPDATE `groups` SET last_seq = GREATEST(last_seq, "
+            "(SELECT COALESCE(MAX(m.seq), 0) FROM messages m WHERE m.group_id = `groups`.id)) "
+            f"WHERE id IN ({', '.join(['%s'] * len(group_ids))})",
+            group_ids
+        )
+
+    def history_before(self, group_id, before_id, limit):
+        # Up to limit messages older than before_id, newest first
+        return self.fetch_all(GROUP_HISTORY_PAGE_QUERY, (group_id, before_id, limit))
+
+    def history_after(self, group_id, after_id, limit):
+        # Up to limit messages newer than after_id, oldest first
+        return self.fetch_all(GROUP_HISTORY_AFTER_QUERY, (group_id, after_id, limit))
+
+    def stream_history(self, group_id, before_id, chunk_size):
+        # Everything older than before_id, oldest first, in chunks
+        return self.stream_query(GROUP_HISTORY_STREAM_QUERY, (group_id, before_id), chunk_size)
+
+    def messages_after_seq(self, group_id, seq, limit, skip_sender):
+        # Up to limit messages with a sequence number above seq not sent by skip_sender, in order
+        return self.fetch_all(GROUP_REPLAY_QUERY, (group_id, seq, skip_sender, limit))
+
+    def recent_client_msg_ids(self, limit):
+        # sender, client_msg_id and timestamp of the ones that have an id among the last
+        # limit messages, oldest first
+        return self.fetch_all(RECENT_CLIENT_IDS_QUERY, (limit,))
+
+    def stats(self):
+        return self.pool.stats.snapshot()
+
+    def close(self):
+        self.pool.close()
+
+
+class MySQLStorage(SQLStorage):
+    def __init__(self, pool_size=10, **connect_args):
+        super().__init__(ConnectionPool(size=pool_size, **(connect_args or DB_CONFIG)))
+        try:
+            # Open one connection up front so a bad configuration fails at startup
+            with self.pool.connection():
+                pass
+            log.info("database connected", pool_size=pool_size)
+        except Exception as e:
+            log.error("database connection failed", error=e)
+            raise
+
+
+class SQLiteStorage(SQLStorage):
+    # SQLitePool translates the MySQL-flavoured queries and creates the schema on first use
+    def __init__(self, path=DEFAULT_SQLITE_PATH, pool_size=4):
+        super().__init__(SQLitePool(path, pool_size))
+        with self.pool.connection():
+            pass
+        log.info("sqlite database opened", path=path)
+
+
+class MemoryStorage:
+    # Everything in dicts behind one lock. Messages are kept per group in id order, so
+    # history pages are a bisect and a slice.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}  # username -> {'id', 'password_hash'}
+        self.usernames = {}  # user id -> username
+        self.groups = {}  # group id -> group name
+        self.last_seqs = {}  # group id -> highest sequence number written
+        self.members = {}  # group id -> {username: user id}
+        self.user_groups = {}  # user id -> {group id: None}, in join order
+        self.messages = {}  # group id -> rows in id order
+        self.message_ids = {}  # group id -> the ids of those rows, for bisect
+        self.client_msg_ids = set()  # (sender id, client_msg_id) of stored messages, like the SQL unique key
+        self.last_user_id = 0
+        self.last_group_id = 0
+        self.last_message_id = 0
+
+    # Users
+
+    def get_user(self, username):
+        with self.lock:
+            user = self.users.get(username)
+            return dict(user) if user else None
+
+    def get_user_id(self, username):
+        with self.lock:
+            user = self.users.get(username)
+            return user['id'] if user else None
+
+    def create_user(self, username, password_hash):
+        with self.lock:
+            if username in self.users:
+                raise ValueError(f"Duplicate username: {username}")
+            self.last_user_id += 1
+            # Stored as text, the way the SQL backends hand it back
+            if isinstance(password_hash, bytes):
+                password_hash = password_hash.decode()
+            self.users[username] = {'id': self.last_user_id, 'password_hash': password_hash}
+            self.usernames[self.last_user_id] = username
+            return self.last_user_id
+
+    # Groups and memberships
+
+    def create_group(self, group_name, creator_id):
+        with self.lock:
+            self.last_group_id += 1
+            group_id = self.last_group_id
+            self.groups[group_id] = group_name
+            self.last_seqs[group_id] = 0
+            self.members[group_id] = {}
+            self.messages[group_id] = []
+            self.message_ids[group_id] = []
+        self.add_member(group_id, creator_id)
+        return group_id
+
+    def get_group_name(self, group_id):
+        with self.lock:
+            return self.groups.get(group_id)
+
+    def get_group_members(self, group_id):
+        with self.lock:
+            return list(self.members.get(group_id, ()))
+
+    def add_member(self, group_id, user_id):
+        with self.lock:
+            if group_id not in self.groups or user_id not in self.usernames:
+                raise ValueError("Unknown group or user")
+            members = self.members[group_id]
+            username = self.usernames[user_id]
+            if username in members:
+                raise ValueError("Duplicate group member")
+            members[username] = user_id
+            self.user_groups.setdefault(user_id, {})[group_id] = None
+
+    def remove_member(self, group_id, user_id):
+        with self.lock:
+            self.members.get(group_id, {}).pop(self.usernames.get(user_id), None)
+            self.user_groups.get(user_id, {}).pop(group_id, None)
+
+    def get_user_groups(self, user_id):
+        with self.lock:
+            return [{'group_id': group_id, 'group_name': self.groups[group_id],
+                     'last_seq': self.last_seqs.get(group_id, 0)}
+                    for group_id in self.user_groups.get(user_id, ())]
+
+    # Group sequence numbers
+
+    def last_seq(self, group_id):
+        with self.lock:
+            return self.last_seqs.get(group_id, 0)
+
+    # Messages
+
+    def insert_messages(self, rows):
+        with self.lock:
+            for sender_id, content, message_type, group_id, timestamp, seq, client_msg_id in rows:
+                if group_id not in self.groups:
+                    continue
+                if client_msg_id is not None:
+                    if (sender_id, client_msg_id) in self.client_msg_ids:
+                        continue
+                    self.client_msg_ids.add((sender_id, client_msg_id))
+                self.last_message_id += 1
+                self.messages[group_id].append({
+                    'id': self.last_message_id,
+                    'content': content,
+                    'timestamp': timestamp,
+                    'seq': seq,
+                    'sender': self.usernames[sender_id],
+                })
+                self.message_ids[group_id].append(self.last_message_id)
+                self.last_seqs[group_id] = max(self.last_seqs[group_id], seq)
+
+    def history_before(self, group_id, before_id, limit):
+        with self.lock:
+            rows = self.messages.get(group_id, [])
+            end = bisect.bisect_left(self.message_ids.get(group_id, []), before_id)
+            return rows[max(end - limit, 0):end][::-1]
+
+    def history_after(self, group_id, after_id, limit):
+        with self.lock:
+            rows = self.messages.get(group_id, [])
+            start = bisect.bisect_right(self.message_ids.get(group_id, []), after_id)
+            return rows[start:start + limit]
+
+    def stream_history(self, group_id, before_id, chunk_size):
+        with self.lock:
+            end = bisect.bisect_left(self.message_ids.get(group_id, []), before_id)
+            rows = self.messages.get(group_id, [])[:end]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def messages_after_seq(self, group_id, seq, limit, skip_sender):
+        # Linear scan from the end; replays are short and rare
+        with self.lock:
+            rows = self.messages.get(group_id, [])
+            start = len(rows)
+            while start > 0 and rows[start - 1]['seq'] > seq:
+                start -= 1
+            return [row for row in rows[start:] if row['sender'] != skip_sender][:limit]
+
+    def recent_client_msg_ids(self, limit):
+        # Nothing outlives the process, so there is nothing to resume after a restart
+        return []
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass